@@ -0,0 +1,890 @@
+# Benchmark the faster implementations of some steps against the original ones
+# run from repository root directory 'google-books-ngram-frequency'
+
+import pandas as pd
+import numpy as np
+import asyncio, gzip, io, json, os, random, re, shutil, socket, subprocess, sys
+import threading, time, tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+from timeit import default_timer as timer
+
+import download_and_extract_most_freq as extract
+import gather_and_clean as gather
+import ngram_index
+import ngram_server
+import google_cloud_translate as translate
+
+
+###############################################################################
+# Settings
+
+# Number of lines in the synthetic .gz file
+synthetic_shard_lines = 200000
+
+# Where to put the synthetic .gz file
+synthetic_shard_path = "ngrams/more/tmp_synthetic_shard.gz"
+
+# Number of lines of the synthetic .gz file with many equally frequent
+# ngrams, the frequencies they are drawn from, and the top-K to keep of it
+tied_shard_lines = 300000
+tied_shard_freqs = [1000, 2000, 3000, 5000]
+tied_top_k = 100
+
+# Number of synthetic .gz files served over HTTP to test the download
+# scheduler, the number of lines of each, and where to put them
+served_shards = 12
+served_shard_lines = 20000
+served_shards_path = "ngrams/more/tmp_synthetic_shards"
+
+# Share of the responses of the local HTTP server cut off at a random byte
+# to test resuming downloads
+flaky_drop_rate = 0.8
+
+# Languages whose raw 1gram tables are used to benchmark cleaning steps
+cleaning_langs = ["english", "german"]
+
+# Where to put the index built to time building it
+index_benchmark_path = "ngrams/more/tmp_ngram_index.bin"
+
+# Load test of ngram_server.py: number of concurrent connections, requests
+# per connection, and ngrams looked up per request
+server_connections = 16
+server_requests = 200
+server_batch_size = 100
+
+# Seconds a request to the fake translation backend takes, and where to
+# put its translation cache
+fake_translation_latency = 0.05
+fake_translation_cache_path = "ngrams/more/tmp_translation_cache.sqlite"
+
+
+###############################################################################
+# Functions
+
+def make_synthetic_shard(path, nlines, seed=0):
+    """Writes a .gz file formatted like the Google Books ngram files,
+    with 'nlines' random ngrams, and returns its path."""
+
+    rng = random.Random(seed)
+    words = ["the", "of", "and", "l'homme", "qu'il", "Haus", "дом", "1,000",
+             "._.", "run_VERB", "_NOUN_", "naïve", "über", "c'est", "x"]
+
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+
+        for i in range(nlines):
+
+            ngram = " ".join(rng.choice(words)
+                             for j in range(rng.randint(1, 5))) + str(i)
+            first_year = rng.randint(1500, 2019)
+            years = sorted(rng.sample(range(first_year, 2020),
+                                      min(rng.randint(1, 60),
+                                          2020 - first_year)))
+            # most ngrams are rare, as in the actual data
+            scale = 10**min(rng.expovariate(1.0), 7)
+            freqs = [max(1, int(scale * rng.uniform(0.5, 1.5)))
+                     for year in years]
+            year_freq = [f"{year},{freq},{rng.randint(1, min(freq, 999))}"
+                         for year, freq in zip(years, freqs)]
+            f.write(ngram + "\t" + "\t".join(year_freq) + "\n")
+
+    return path
+
+
+def get_most_freq_df_baseline(path, n):
+    """Returns the dataframe of the most frequent ngrams of the .gz file at
+    path as the original 'get_most_freq_from_gz_file' computed it, using
+    'extract_ngram_sum_freq' line by line."""
+
+    ngrams = list()
+    freqs = list()
+
+    with gzip.open(path, 'rt') as f:
+        for line in f:
+            ngram, freq = extract.extract_ngram_sum_freq(line)
+            if freq >= extract.min_freq_to_keep[n]:
+                ngrams += [ngram]
+                freqs += [freq]
+
+    df = pd.DataFrame({'ngram': ngrams,
+                       'freq': freqs})
+
+    return df.sort_values(by=['freq'], ascending=False)
+
+
+def benchmark_parsers(path, n=1):
+    """Times the original parser, and the line by line and the batched
+    parser on the .gz file at path and checks that they all produce
+    csv-output byte-identical to the original one."""
+
+    start = timer()
+    df = get_most_freq_df_baseline(path, n)
+    end = timer()
+
+    outputs = {"original": df.to_csv(index=False)}
+    print(f"original parser: {round(end - start, 2)}s, "
+          f"{df.shape[0]} ngrams kept")
+
+    for batched in [False, True]:
+
+        start = timer()
+        with gzip.open(path, 'rb') as f:
+            df = extract.get_most_freq_df(f, n, batched)
+        end = timer()
+
+        outputs[batched] = df.to_csv(index=False)
+        print(f"{'batched' if batched else 'line by line'} parser: "
+              f"{round(end - start, 2)}s, {df.shape[0]} ngrams kept")
+
+    print("identical output:", len(set(outputs.values())) == 1)
+    assert len(set(outputs.values())) == 1
+
+
+def make_tied_shard(path, nlines, freqs, seed=0):
+    """Writes a .gz file formatted like the Google Books ngram files,
+    with 'nlines' ngrams occurring in one year each with a frequency drawn
+    from 'freqs', so that many are equally frequent, and returns its
+    path."""
+
+    rng = random.Random(seed)
+
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        for i in range(nlines):
+            f.write(f"ngram{i}\t{extract.year_end},{rng.choice(freqs)},1\n")
+
+    return path
+
+
+def benchmark_top_k(path, k, n=1):
+    """Times the line by line and the batched parser keeping only the k
+    most frequent ngrams of the .gz file at path, and checks that both
+    produce the same csv-output as the first k rows of the full list
+    sorted with equally frequent ngrams in file order."""
+
+    with gzip.open(path, 'rb') as f:
+        full = extract.get_most_freq_df(f, n, True)
+    full = full.sort_index().sort_values(by=['freq'], ascending=False,
+                                         kind='stable').head(k)
+    outputs = {"full list": full.to_csv(index=False)}
+
+    for batched in [False, True]:
+
+        start = timer()
+        with gzip.open(path, 'rb') as f:
+            df = extract.get_most_freq_df(f, n, batched, top_k=k)
+        end = timer()
+
+        outputs[batched] = df.to_csv(index=False)
+        print(f"{'batched' if batched else 'line by line'} parser, "
+              f"top {k}: {round(end - start, 2)}s")
+
+    print("identical output:", len(set(outputs.values())) == 1)
+
+
+def make_shard_handler(directory, drop_rate=0.0, seed=0):
+    """Returns a class of request handlers serving the files in directory
+    over persistent connections, honouring Range requests "bytes=start-"
+    like the Google Books server. A share drop_rate of the responses is
+    cut off after a random number of bytes by closing the connection; the
+    number of responses cut off is counted in the class attribute
+    'dropped'."""
+
+    rng = random.Random(seed)
+    lock = threading.Lock()
+
+    class ShardHandler(BaseHTTPRequestHandler):
+
+        dropped = 0
+
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+
+            path = directory + '/' + os.path.basename(urlsplit(self.path).path)
+            if not os.path.isfile(path):
+                self.send_error(404)
+                return
+
+            with open(path, 'rb') as f:
+                data = f.read()
+
+            ranged = re.match(r"^bytes=(\d+)-$", self.headers.get("Range", ""))
+            start = int(ranged.group(1)) if ranged else 0
+
+            if start >= len(data) and ranged:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            self.send_response(206 if ranged else 200)
+            if ranged:
+                self.send_header("Content-Range",
+                                 f"bytes {start}-{len(data) - 1}/{len(data)}")
+            self.send_header("Content-Length", str(len(data) - start))
+            self.end_headers()
+
+            end = len(data)
+            with lock:
+                if rng.random() < drop_rate:
+                    end = rng.randrange(start, len(data))
+                    ShardHandler.dropped += 1
+
+            self.wfile.write(data[start:end])
+            if end < len(data):
+                self.close_connection = True
+
+    return ShardHandler
+
+
+def serve_shards(directory, drop_rate=0.0):
+    """Serves the files in directory on a free local port in a thread (see
+    'make_shard_handler'). Returns the server and the url of the folder."""
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0),
+                                 make_shard_handler(directory, drop_rate))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def benchmark_scheduler(nshards, nlines, n=1):
+    """Serves nshards synthetic .gz files of nlines lines each from a local
+    HTTP server, downloads and processes them one after the other and with
+    'download_and_process_gz_files_scheduled' on all but two cores, and
+    checks that both write identical lists of most frequent ngrams. Then
+    checks that the scheduler raises the error of a file missing on the
+    server instead of hanging, if not continue_on_exception, and that
+    'download_and_process_all_gz_files' finishes the other files and keeps
+    the partial file of a download failing for good, if
+    continue_on_exception."""
+
+    os.makedirs(served_shards_path, exist_ok=True)
+    names = [f"{n}-{i:05d}-of-{nshards:05d}.gz" for i in range(nshards)]
+    for i, name in enumerate(names):
+        make_synthetic_shard(served_shards_path + '/' + name, nlines, seed=i)
+
+    server, base_url = serve_shards(served_shards_path)
+    urls = [base_url + name for name in names]
+    settings = (extract.use_manifest, extract.continue_on_exception,
+                extract.download_retries, extract.download_backoff,
+                extract.number_of_cores)
+    extract.use_manifest = False
+    extract.number_of_cores = max(os.cpu_count() - 2, 1)
+    extract.continue_on_exception = False
+    langs = ["tmp_sequential", "tmp_scheduled"]
+
+    try:
+        start = timer()
+        for i in range(len(urls)):
+            extract.download_and_process_one_gz_file2(langs[0], n, urls, i)
+        print(f"one file after the other: {round(timer() - start, 2)}s")
+
+        start = timer()
+        extract.download_and_process_gz_files_scheduled(
+            [(langs[1], n, url) for url in urls])
+        print(f"scheduled: {round(timer() - start, 2)}s")
+
+        outputs = list()
+        for lang in langs:
+            outputs += [list()]
+            for url in urls:
+                with open(extract.per_gz_file_path(lang) + '/'
+                          + extract.per_gz_file_name(url), 'rb') as f:
+                    outputs[-1] += [f.read()]
+        print("identical output:", outputs[0] == outputs[1])
+
+        try:
+            extract.download_and_process_gz_files_scheduled(
+                [(langs[1], n, url) for url in urls[:2]]
+                + [(langs[1], n, base_url + "missing.gz")])
+        except extract.HTTPError as e:
+            print("missing file raised:", e.code)
+        else:
+            raise AssertionError("the missing file was not raised")
+
+        # a server cutting off every response, so that downloads from it
+        # fail after download_retries retries
+        extract.continue_on_exception = True
+        extract.download_retries = 1
+        extract.download_backoff = 0
+        failing_server, failing_url = serve_shards(served_shards_path, 1.0)
+        shutil.rmtree(f"ngrams/more/{langs[1]}")
+        try:
+            finished = extract.download_and_process_all_gz_files(
+                [(langs[1], n, failing_url + names[0])]
+                + [(langs[1], n, url) for url in urls[1:]])
+        finally:
+            failing_server.shutdown()
+            failing_server.server_close()
+        kept = os.listdir(f"ngrams/more/{langs[1]}/tmp")
+        print(f"with a download failing for good: {len(finished)} of "
+              f"{len(urls)} files finished, partial files kept: {kept}")
+        assert sorted(finished) == urls[1:] and kept == names[:1]
+
+    finally:
+        (extract.use_manifest, extract.continue_on_exception,
+         extract.download_retries, extract.download_backoff,
+         extract.number_of_cores) = settings
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(served_shards_path)
+        for lang in langs:
+            shutil.rmtree(f"ngrams/more/{lang}", ignore_errors=True)
+
+
+def check_resumable_download(path, drop_rate):
+    """Serves the .gz file at path from a local HTTP server which cuts off
+    a share drop_rate of its responses, and checks that the data
+    decompressed from a 'ResumableHTTPStream' of it, and the file
+    downloaded by 'download_gz_file', are identical to the original."""
+
+    directory, name = os.path.split(path)
+    server, base_url = serve_shards(directory, drop_rate)
+    settings = (extract.download_retries, extract.download_backoff)
+    extract.download_retries = 100
+    extract.download_backoff = 0
+    download_path = path + ".downloaded"
+
+    with gzip.open(path, 'rb') as f:
+        original = f.read()
+
+    try:
+        with io.BufferedReader(extract.ResumableHTTPStream(base_url + name),
+                               2**16) as stream:
+            with extract.open_gz(stream) as f:
+                streamed = f.read()
+
+        extract.download_gz_file(base_url + name, download_path)
+        with open(download_path, 'rb') as f:
+            downloaded = f.read()
+        with open(path, 'rb') as f:
+            identical_file = downloaded == f.read()
+
+    finally:
+        extract.download_retries, extract.download_backoff = settings
+        server.shutdown()
+        server.server_close()
+        if os.path.exists(download_path):
+            os.remove(download_path)
+
+    print(f"resumed after {server.RequestHandlerClass.dropped} dropped "
+          f"connections, identical decompressed data: "
+          f"{streamed == original}, identical file: {identical_file}")
+    assert server.RequestHandlerClass.dropped > 0
+    assert streamed == original and identical_file
+
+
+def check_failing_download(path, retries=3):
+    """Serves the .gz file at path from a local HTTP server which cuts off
+    every response, and checks that 'download_gz_file' gives up after
+    'retries' retries, although each of them gets a bit further."""
+
+    directory, name = os.path.split(path)
+    server, base_url = serve_shards(directory, 1.0)
+    settings = (extract.download_retries, extract.download_backoff)
+    extract.download_retries = retries
+    extract.download_backoff = 0
+    download_path = path + ".downloaded"
+
+    try:
+        extract.download_gz_file(base_url + name, download_path)
+    except (OSError, extract.http.client.HTTPException) as e:
+        print(f"failing download raised after "
+              f"{server.RequestHandlerClass.dropped} requests: {e!r}")
+    else:
+        raise AssertionError("the failing download was not raised")
+    finally:
+        extract.download_retries, extract.download_backoff = settings
+        server.shutdown()
+        server.server_close()
+        if os.path.exists(download_path):
+            os.remove(download_path)
+
+    assert server.RequestHandlerClass.dropped == retries + 1
+
+
+def benchmark_decompression(path):
+    """Reports the decompression speed of each backend on the .gz file at
+    path in MB/s of decompressed data."""
+
+    for backend in ["gzip", "zlib", "isal", "pigz"]:
+
+        nbytes = 0
+
+        start = timer()
+        with extract.open_gz(path, backend) as f:
+            while True:
+                block = f.read(extract.parse_block_size)
+                if not block:
+                    break
+                nbytes += len(block)
+        end = timer()
+
+        fallback = ""
+        if ((backend == "isal" and extract.igzip is None)
+            or (backend == "pigz" and shutil.which("pigz") is None)):
+            fallback = " (not available, used zlib)"
+
+        print(f"{backend}{fallback}: "
+              f"{round(nbytes / 1e6 / (end - start), 1)} MB/s")
+
+
+def time_and_trace(f, *args):
+    """Returns the result of f(*args), the seconds it took, and the peak
+    memory allocated meanwhile in MB."""
+
+    tracemalloc.start()
+    start = timer()
+    result = f(*args)
+    end = timer()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, end - start, peak / 1e6
+
+
+def benchmark_merge_upcase_lowcase(langs):
+    """Times merge_upcase_lowcase and the original implementation on the
+    raw 1gram tables of 'langs', reports their peak memory use, and checks
+    that they give identical results."""
+
+    for lang in langs:
+
+        d = pd.read_csv(f"ngrams/more/{lang}/1grams_{lang}_0_raw.csv")
+        d = d[~d.ngram.isnull()]
+        outputs = list()
+
+        for f in [gather.merge_upcase_lowcase_with_merges,
+                  gather.merge_upcase_lowcase]:
+            df, seconds, peak = time_and_trace(f, d.copy(), 0.92)
+            outputs += [df]
+            print(f"{lang}, {f.__name__}: {round(seconds, 3)}s, "
+                  f"peak memory {round(peak, 1)} MB")
+
+        print("identical output:", outputs[0].equals(outputs[1]))
+
+
+def benchmark_split_contractions(lang="french"):
+    """Times split_contractions and the original implementation on the
+    raw 1- to 5gram tables of lang and checks that they give identical
+    results."""
+
+    for n in range(1, 6):
+
+        d = pd.read_csv(f"ngrams/more/{lang}/{n}grams_{lang}_0_raw.csv")
+        d = d[~d.ngram.isnull()]
+        outputs = list()
+
+        for f in [gather.split_contractions_with_apply,
+                  gather.split_contractions]:
+            dother = {key: pd.DataFrame({'ngram': [], 'freq': []})
+                      for key in range(1, 11)}
+            start = timer()
+            df, dother = f(d.copy(), dother)
+            end = timer()
+            outputs += [[df.to_csv()] + [dother[key].to_csv()
+                                         for key in dother]]
+            print(f"{lang}, n={n}, {f.__name__}: "
+                  f"{round(end - start, 3)}s")
+
+        print("identical output:", outputs[0] == outputs[1])
+
+
+def classify_ngrams_with_loop(ngrams, rules):
+    """Classifies ngrams as 'gather.classify_ngrams' does, checking all
+    rules for one ngram after the other in a Python loop."""
+
+    compiled = [(re.compile(rule).search if isinstance(rule, str)
+                 else set(rule).__contains__, set(exceptions))
+                for reason, rule, exceptions in rules]
+
+    def classify(ngram):
+        for i, (matches, exceptions) in enumerate(compiled, start=1):
+            if matches(ngram) and ngram not in exceptions:
+                return i
+        return 0
+
+    return np.array([classify(ngram) for ngram in ngrams], dtype=np.int8)
+
+
+def classify_ngrams_with_alternation(ngrams, rules):
+    """Classifies ngrams as 'gather.classify_ngrams' does, with one
+    str.extract of a regex alternating between the regex rules in order,
+    each a named group matching the empty string at the start of the
+    ngrams it removes, and one isin per list rule."""
+
+    alternatives = list()
+    for i, (reason, rule, exceptions) in enumerate(rules, start=1):
+        if isinstance(rule, str):
+            # an exception makes the next alternative be tried
+            excluded = "|".join(re.escape(e) for e in exceptions)
+            alternatives += [rf"(?P<rule{i}>(?=[\s\S]*?(?:{rule}))"
+                             + (rf"(?!(?:{excluded})\Z)" if excluded else "")
+                             + ")"]
+    groups = ngrams.str.extract("^(?:" + "|".join(alternatives) + ")")
+    groups = groups[[column for column in groups.columns
+                     if str(column).startswith("rule")]]
+
+    matched = groups.notna().to_numpy()
+    numbers = np.array([int(column[4:]) for column in groups.columns])
+    reasons = np.zeros(len(ngrams), dtype=np.int8)
+    any_matched = matched.any(axis=1)
+    reasons[any_matched] = numbers[matched[any_matched].argmax(axis=1)]
+
+    # a list rule applies where no earlier rule does
+    for i, (reason, rule, exceptions) in enumerate(rules, start=1):
+        if not isinstance(rule, str):
+            removes = (ngrams.isin(rule)
+                       & ~ngrams.isin(exceptions)).to_numpy()
+            reasons[removes & ((reasons == 0) | (reasons > i))] = i
+
+    return reasons
+
+
+def benchmark_classify_ngrams(langs, repeats=10):
+    """Times classify_ngrams, a loop over the ngrams and one regex
+    alternating between the rules on the raw 1- to 5gram tables of
+    'langs', each repeated 'repeats' times, with the rules for removing
+    ngrams while cleaning, and checks that they give identical results."""
+
+    for lang in langs:
+        for n in range(1, 6):
+
+            path = f"ngrams/more/{lang}/{n}grams_{lang}_0_raw.csv"
+            if not os.path.exists(path):
+                continue
+            d = pd.read_csv(path)
+            ngrams = pd.concat([d.ngram[~d.ngram.isnull()]] * repeats,
+                               ignore_index=True)
+            rules = gather.removal_rules(lang, n)
+            outputs = list()
+
+            for name, f in [("loop", classify_ngrams_with_loop),
+                            ("alternation",
+                             classify_ngrams_with_alternation),
+                            ("classify_ngrams",
+                             lambda ngrams, rules: gather.classify_ngrams(
+                                 ngrams, gather.compile_rules(rules)))]:
+                start = timer()
+                outputs += [f(ngrams, rules)]
+                end = timer()
+                print(f"{lang}, n={n}, {len(ngrams)} ngrams, {name}: "
+                      f"{round(end - start, 3)}s")
+
+            print("identical output:",
+                  all(np.array_equal(outputs[0], output)
+                      for output in outputs[1:]))
+
+
+async def load_test_connection(requests, latencies):
+    """Sends the POST requests 'requests' one after the other over one
+    keep-alive connection to ngram_server and appends their latencies."""
+
+    reader, writer = await asyncio.open_connection(ngram_server.host,
+                                                   ngram_server.port)
+
+    for body in requests:
+
+        start = timer()
+        writer.write((f"POST /lookup HTTP/1.1\r\n"
+                      f"Host: {ngram_server.host}\r\n"
+                      f"Content-Length: {len(body)}\r\n\r\n")
+                     .encode('latin-1') + body)
+        await writer.drain()
+
+        length = None
+        while True:
+            line = await reader.readline()
+            if line == b"\r\n":
+                break
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":")[1])
+        await reader.readexactly(length)
+
+        latencies.append(timer() - start)
+
+    writer.close()
+
+
+async def load_test(requests):
+    """Runs load_test_connection for each list of requests in 'requests'
+    at once and returns the latencies of all requests."""
+
+    latencies = list()
+    await asyncio.gather(*[load_test_connection(r, latencies)
+                           for r in requests])
+
+    return latencies
+
+
+def get_json(path):
+    """Returns the JSON response of ngram_server to a GET request."""
+
+    with socket.create_connection((ngram_server.host, ngram_server.port)) \
+            as s:
+        s.sendall(f"GET {path} HTTP/1.1\r\nConnection: close\r\n\r\n"
+                  .encode('latin-1'))
+        response = b""
+        while True:
+            data = s.recv(2**16)
+            if not data:
+                break
+            response += data
+
+    return json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+
+def benchmark_build_index(path=index_benchmark_path):
+    """Times building the index of all final lists, which ngram_server.py
+    does at startup if there is none, and how much of it compiling the
+    tries takes, and reports the size of the index and the language of the
+    translations of each list which has them."""
+
+    seconds_in_tries = list()
+    compile_trie = ngram_index.compile_trie
+
+    def timed_compile_trie(*args):
+        start = timer()
+        result = compile_trie(*args)
+        seconds_in_tries.append(timer() - start)
+        return result
+
+    ngram_index.compile_trie = timed_compile_trie
+    try:
+        start = timer()
+        ngram_index.build_index(path)
+        end = timer()
+    finally:
+        ngram_index.compile_trie = compile_trie
+
+    index = ngram_index.load_index(path)
+    print(f"index of {len(index['tables'])} lists: {round(end - start, 2)}s,"
+          f" of which compiling the tries {round(sum(seconds_in_tries), 2)}s"
+          f", {round(os.path.getsize(path) / 1e6, 1)} MB")
+    print("translations:", {f"{lang}, n={n}": table["translation_lang"]
+                            for (lang, n), table in index["tables"].items()
+                            if table["translations"]})
+
+    index["buf"].close()
+    os.remove(path)
+
+
+def benchmark_server(lang="french", n=1):
+    """Starts ngram_server.py and sends batched lookups of random ngrams
+    from the list of n-grams of lang to it over server_connections
+    connections at once. Reports the throughput and the latencies measured
+    by the clients, and the metrics reported by the server."""
+
+    d = pd.read_csv(f"ngrams/{n}grams_{lang}.csv", keep_default_na=False,
+                    dtype={'ngram': str})
+    rng = random.Random(0)
+    requests = [[json.dumps({"lang": lang, "n": n,
+                             "ngrams": rng.sample(list(d.ngram),
+                                                  server_batch_size)})
+                 .encode('utf-8') for j in range(server_requests)]
+                for i in range(server_connections)]
+
+    server = subprocess.Popen([sys.executable, "python/ngram_server.py"])
+
+    try:
+        # wait until the server accepts connections
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError("ngram_server.py exited")
+            try:
+                socket.create_connection((ngram_server.host,
+                                          ngram_server.port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        start = timer()
+        latencies = sorted(asyncio.run(load_test(requests)))
+        end = timer()
+
+        print(f"{len(latencies)} requests of {server_batch_size} ngrams over "
+              f"{server_connections} connections: "
+              f"{round(len(latencies) / (end - start))} requests/s, "
+              f"{round(len(latencies) * server_batch_size / (end - start))} "
+              f"ngrams/s, latency p50 "
+              f"{round(1e3 * latencies[len(latencies) // 2], 2)} ms, p99 "
+              f"{round(1e3 * latencies[int(0.99 * len(latencies))], 2)} ms")
+        print("server metrics:", get_json("/metrics"))
+
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def make_fake_translation_backend(fail_on=None):
+    """Returns a fake translation backend for 'translate_with_cache',
+    which takes fake_translation_latency seconds per request and fails on
+    the fail_on-th request if given, and a dictionary counting the
+    requests and characters sent to it and the texts it translated."""
+
+    sent = {"requests": 0, "characters": 0, "translated": 0}
+    lock = threading.Lock()
+
+    def backend(texts, target, source):
+        with lock:
+            sent["requests"] += 1
+            sent["characters"] += len("".join(texts))
+            request = sent["requests"]
+        time.sleep(fake_translation_latency)
+        if request == fail_on:
+            raise RuntimeError("fake translation request failed")
+        with lock:
+            sent["translated"] += len(texts)
+        return [fake_translation(text, target, source) for text in texts]
+
+    return backend, sent
+
+
+def fake_translation(text, target, source):
+    """Returns the translation of text by the fake translation backend."""
+
+    return f"{text} ({source}->{target})"
+
+
+def check_failed_translation(requested):
+    """Translates 'requested' (see 'translate_with_cache') with a fake
+    backend failing on its second request and checks that the batches not
+    sent yet are cancelled and that every text translated by the requests
+    sent is cached."""
+
+    backend, sent = make_fake_translation_backend(fail_on=2)
+    batches = sum(len(translate.pack_batches(texts,
+                                             translate.translate_batch_size,
+                                             translate.translate_batch_chars))
+                  for texts in requested.values())
+
+    try:
+        translate.translate_with_cache(requested, backend,
+                                       fake_translation_cache_path)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError("the failed request was not raised")
+
+    con = translate.open_translation_cache(fake_translation_cache_path)
+    cached = con.execute("SELECT COUNT(*) FROM translations").fetchone()[0]
+    con.close()
+    os.remove(fake_translation_cache_path)
+
+    print(f"failing on the second request: {sent['requests']} of {batches} "
+          f"requests sent, {cached} of {sent['translated']} texts "
+          f"translated cached")
+    assert sent["requests"] < batches
+    assert cached == sent["translated"]
+
+
+def benchmark_translation_cache(ns=[1, 2, 3, 4, 5]):
+    """Translates all lists of n-grams in ns of the non-English languages
+    with a fake backend: first one list after the other in fixed batches
+    of 128 strings, as before the translation cache, then all at once
+    through 'translate_with_cache' twice, the second time with a full
+    cache. Reports the requests and characters sent and the time taken,
+    and checks the translations returned, that nothing is sent with a
+    full cache, and what is cached when a request fails."""
+
+    langs = ["chinese_simplified", "french", "german", "hebrew", "italian",
+             "russian", "spanish"]
+    requested = dict()
+    for lang in langs:
+        for n in ns:
+            d = pd.read_csv(translate.ngramlist_path(n, lang))
+            requested.setdefault(("en", translate.langiso[lang]),
+                                 list()).append(list(d['ngram'].dropna()))
+
+    backend, sent = make_fake_translation_backend()
+    start = timer()
+    for (target, source), lists in requested.items():
+        for texts in lists:
+            for i in range(0, len(texts), 128):
+                backend(texts[i:i+128], target, source)
+    print(f"one list after the other: {sent['requests']} requests, "
+          f"{sent['characters']} characters, {round(timer() - start, 2)}s")
+
+    requested = {pair: set().union(*lists)
+                 for pair, lists in requested.items()}
+
+    for run in ["empty cache", "full cache"]:
+        backend, sent = make_fake_translation_backend()
+        start = timer()
+        translations = translate.translate_with_cache(
+            requested, backend, fake_translation_cache_path)
+        print(f"with translation cache, {run}: {sent['requests']} requests, "
+              f"{sent['characters']} characters, "
+              f"{round(timer() - start, 2)}s")
+        assert all(translations[(target, source)][text]
+                   == fake_translation(text, target, source)
+                   for (target, source), texts in requested.items()
+                   for text in texts)
+        if run == "full cache":
+            assert sent["requests"] == 0
+
+    os.remove(fake_translation_cache_path)
+
+    check_failed_translation(requested)
+
+
+def benchmark_fix_case(n=5, outlang="english", seed=0):
+    """Times fix_case and the original implementation on the lists of
+    n-grams of outlang and english-fiction, with the case of the first
+    character or of the whole string randomly changed as in translations
+    returned by Google, and checks that they give identical results."""
+
+    rng = random.Random(seed)
+    arr = list()
+    for lang in [outlang, "english-fiction"]:
+        d = pd.read_csv(f"ngrams/{n}grams_{lang}.csv", keep_default_na=False,
+                        dtype={'ngram': str})
+        for ngram in d.ngram:
+            r = rng.random()
+            if r < 0.3:
+                ngram = ngram[:1].swapcase() + ngram[1:]
+            elif r < 0.4:
+                ngram = ngram.upper()
+            arr += [ngram]
+
+    outputs = list()
+
+    for f in [translate.fix_case_with_scans, translate.fix_case]:
+        start = timer()
+        outputs += [f(np.array(arr, dtype=object), outlang)]
+        end = timer()
+        print(f"{len(arr)} {n}-grams, {f.__name__}: "
+              f"{round(end - start, 3)}s")
+
+    print("identical output:", list(outputs[0]) == list(outputs[1]))
+
+
+###############################################################################
+# Run
+
+if __name__ == '__main__':
+    path = make_synthetic_shard(synthetic_shard_path, synthetic_shard_lines)
+    benchmark_parsers(path)
+    benchmark_decompression(path)
+    check_resumable_download(path, flaky_drop_rate)
+    check_failing_download(path)
+    os.remove(path)
+    path = make_tied_shard(synthetic_shard_path, tied_shard_lines,
+                           tied_shard_freqs)
+    benchmark_parsers(path)
+    benchmark_top_k(path, tied_top_k)
+    os.remove(path)
+    benchmark_scheduler(served_shards, served_shard_lines)
+    benchmark_merge_upcase_lowcase(cleaning_langs)
+    benchmark_split_contractions()
+    benchmark_classify_ngrams(cleaning_langs)
+    benchmark_build_index()
+    benchmark_server()
+    benchmark_translation_cache()
+    benchmark_fix_case()
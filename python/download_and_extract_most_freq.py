@@ -2,11 +2,21 @@
 # https://storage.googleapis.com/books/ngrams/books/datasetsv3.html
 
 import pandas as pd
-import wget, gzip, os, re
+import numpy as np
+import wget, gzip, hashlib, heapq, io, json, os, re, queue, shutil
+import subprocess, threading, time, zlib
+import http.client
 import multiprocessing as mp
 from timeit import default_timer as timer
-from urllib.request import urlopen
+from urllib.error import HTTPError
+from urllib.parse import urljoin, urlsplit
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+try:
+    from isal import igzip
+except ImportError:
+    igzip = None
 
 ###############################################################################
 # Settings
@@ -29,6 +39,21 @@ year_start = 2010
 # Only consider books published up to and including this year
 year_end = 2019
 
+# Further periods (first year, last year) for which to extract lists of
+# most frequent ngrams in the same pass over each .gz file, e.g.
+# [(2000, 2009), (1470, 2019)]; the lists for each period are saved in
+# per_gz_file_path with "_{first year}-{last year}" appended; .gz files
+# already handled are not handled again for a newly added period
+extra_year_windows = []
+
+# Also save, for each ngram in the list of most frequent ngrams of each .gz
+# file for year_start to year_end, its match count and number of volumes
+# in each year from year_counts_start to 2019, as arrays in .npy files
+# which can be memory-mapped (see load_year_counts); other periods can then
+# be summed up (see sum_year_counts) without downloading the .gz files again
+save_year_counts = False
+year_counts_start = 1900
+
 # When processing each .gz individual file, for each n,
 # discard ngrams occurring less frequently than given here;
 # should be chosen small enough so that none of the 'number_of_most_freq'
@@ -36,13 +61,93 @@ year_end = 2019
 # the code will run faster the larger these numbers
 min_freq_to_keep = {1: 1000, 2: 1000, 3: 1000, 4: 1000, 5: 1000}
 
+# Parse the decompressed .gz files in large blocks using NumPy instead of
+# line by line; the resulting lists of most frequent ngrams are identical
+use_batched_parser = True
+
+# Number of decompressed bytes handed to the batched parser at once
+parse_block_size = 2**22
+
+# How to decompress the .gz files: "zlib" uses zlib directly with large
+# buffers, "gzip" Python's gzip module, "isal" the faster python-isal
+# package, and "pigz" the external pigz program (for downloaded files only);
+# if "isal" or "pigz" is not available, "zlib" is used instead
+decompression_backend = "zlib"
+
+# Number of compressed bytes decompressed at once by the "zlib" backend
+decompression_buffer_size = 2**22
+
+# Only keep the per_file_number_of_most_freq most frequent ngrams of each
+# .gz file, which is all that gather_and_clean.py reads, using a bounded
+# buffer instead of collecting and sorting all ngrams above min_freq_to_keep
+use_top_k = False
+
+# Number of most frequent ngrams to keep per file if use_top_k;
+# these should be the same as in gather_and_clean.py
+per_file_number_of_most_freq = {"chinese_simplified":
+                                {1: 40000, 2: 25000, 3: 25000, 4: 25000,
+                                 5: 25000},
+                                "english":
+                                {1: 25000, 2: 5000, 3: 3000, 4: 3000,
+                                 5: 5000},
+                                "english-fiction":
+                                {1: 40000, 2: 10000, 3: 3000, 4: 3000,
+                                 5: 5000},
+                                "french":
+                                {1: 25000, 2: 5000, 3: 3000, 4: 3000,
+                                 5: 5000},
+                                "german":
+                                {1: 25000, 2: 5000, 3: 3000, 4: 10000,
+                                 5: 20000},
+                                "hebrew":
+                                {1: 50000, 2: 50000, 3: 50000, 4: 50000,
+                                 5: 50000},
+                                "italian":
+                                {1: 25000, 2: 5000, 3: 3000, 4: 3000,
+                                 5: 10000},
+                                "russian":
+                                {1: 25000, 2: 25000, 3: 25000, 4: 25000,
+                                 5: 25000},
+                                "spanish":
+                                {1: 25000, 2: 5000, 3: 3000, 4: 3000,
+                                 5: 5000}}
+
 # Make sure we are in right directory (other paths are relative)
 # os.chdir("my-path-to/google-books-ngram-frequency")
 
-# Number of cores to run on in parallel
-# number_of_cores = mp.cpu_count() - 2
+# Format of the lists of most frequent ngrams per .gz file: "csv", or
+# "bin", a compact binary format which gather_and_clean.py reads faster,
+# using mmap; should be the same as in gather_and_clean.py
+per_gz_file_format = "csv"
+
+# Number of cores to run on in parallel; each process holds the lists of
+# one .gz file being processed, so memory use grows with it
+# number_of_cores = max(mp.cpu_count() - 2, 1)
 number_of_cores = 1
 
+# Number of .gz files to download at the same time
+max_connections = 8
+
+# Number of downloaded .gz files which may wait for a free core (2 times
+# number_of_cores if None); downloads pause while this many are waiting
+max_queued_files = None
+
+# Number of times to retry when a download fails, waiting download_backoff
+# seconds before the first retry and twice as long before each further one;
+# each retry continues where the failed attempt stopped, using HTTP Range
+download_retries = 5
+download_backoff = 2
+
+# Number of bytes a download has to get past the point where it last
+# failed before download_retries retries are available to it again; a
+# connection failing more often than this fails the download
+download_retry_reset_bytes = 2**26
+
+# Keep the partially downloaded .gz files of failed downloads in
+# 'ngrams/more/{lang}/tmp', so that they are continued where they stopped
+# when the script is run again; otherwise they are deleted
+keep_partial_downloads = True
+
 # Redownload and reprocess gz files for which a list of most common ngrams
 # already exists
 redownload_files = False
@@ -52,6 +157,12 @@ redownload_files = False
 # the alternative is to throw the exception
 continue_on_exception = True
 
+# Record the state, size, number of rows, processing time, and checksum of
+# each handled .gz file in the manifest 'ngrams/more/manifest.jsonl' and
+# use it to decide which files still need to be downloaded; otherwise the
+# lists of most common ngrams already in per_gz_file_path are used
+use_manifest = True
+
 # Toggle use of the below custom lists of urls to actually download
 use_custom_url_indices = True
 
@@ -131,7 +242,19 @@ custom_url_indices = {"spanish":
 ###############################################################################
 # Constants etc.
 
-max_relevant_year_freqs = 2019 - year_start + 1
+# year_start to year_end first, then extra_year_windows
+year_windows = [(year_start, year_end)] + extra_year_windows
+
+max_relevant_year_freqs = 2019 - min(
+    [start for start, end in year_windows]
+    + ([year_counts_start] if save_year_counts else [])) + 1
+
+# number of years from year_counts_start to 2019
+year_counts_years = 2019 - year_counts_start + 1
+
+# first bytes of each list of most frequent ngrams in the "bin" format;
+# should be the same as in gather_and_clean.py
+per_gz_file_magic = b"NGRAMS1\n"
 
 langcode = {"english": "eng", "english-us": "eng-us", "english-gb": "eng-gb", 
             "english-fiction": "eng-fiction", "chinese_simplified": "chi_sim", 
@@ -146,24 +269,50 @@ def totalcounts_1_file(lang):
     return (f"source-data/data_googlebooks-{langcode[lang]}-20200217/"
             + "totalcounts_1.txt")
 
+def per_file_top_k(lang, n):
+    """Number of most frequent ngrams to keep per .gz file, if limited."""
+    return per_file_number_of_most_freq[lang][n] if use_top_k else None
+
 def tmp_path(lang):
 
     path = f"ngrams/more/{lang}/tmp"
 
-    if not os.path.exists(path):
-        os.makedirs(path)
+    os.makedirs(path, exist_ok=True)
 
     return path
 
-def per_gz_file_path(lang):
+def per_gz_file_path(lang, window=None):
 
     path = f"ngrams/more/{lang}/most_freq_ngrams_per_gz_file"
 
-    if not os.path.exists(path):
-        os.makedirs(path)
+    if window is not None:
+        path += f"_{window[0]}-{window[1]}"
+
+    os.makedirs(path, exist_ok=True)
+
+    return path
+
+def year_counts_path(lang):
+
+    path = f"ngrams/more/{lang}/most_freq_ngrams_per_gz_file_year_counts"
+
+    os.makedirs(path, exist_ok=True)
 
     return path
 
+def per_gz_file_name(gz_file_url):
+    return f"ngrams_{gz_file_url.split(sep='/')[-1]}.{per_gz_file_format}"
+
+def manifest_path():
+
+    path = "ngrams/more"
+
+    os.makedirs(path, exist_ok=True)
+
+    return path + "/manifest.jsonl"
+
+manifest_lock = threading.Lock()
+
 
 ###############################################################################
 # Functions
@@ -202,72 +351,889 @@ def extract_ngram_sum_freq(line):
     return ngram, freq
 
 
-def get_most_freq_from_gz_file2(gz_file_url, lang, n):
+def extract_ngram_sum_freqs(line):
+    """Extracts ngram and the sums of frequencies across each of the
+    year_windows from one line of a .gz file."""
 
-    try:
-        ngrams = list()
-        freqs = list()
+    list_of_line_elements = line.strip().split('\t')
+
+    ngram = list_of_line_elements[0]
+
+    year_freq = list_of_line_elements[1:]
+    year_freq = year_freq[-max_relevant_year_freqs:]
+
+    freqs = [0] * len(year_windows)
+
+    for yf in year_freq:
+
+        yfs = yf.split(",")
+        year_now = int(yfs[0])
+
+        for w, (start, end) in enumerate(year_windows):
+            if year_now >= start and year_now <= end:
+                freqs[w] += int(yfs[1])
+
+    return ngram, freqs
+
+
+def extract_ngram_year_counts(line):
+    """Extracts ngram and arrays of its match count and number of volumes in
+    each year from year_counts_start to 2019 from one line of a .gz file."""
+
+    list_of_line_elements = line.strip().split('\t')
+
+    match_counts = np.zeros(year_counts_years, dtype=np.int64)
+    volume_counts = np.zeros(year_counts_years, dtype=np.int32)
+
+    for yf in list_of_line_elements[1:]:
+
+        year, freq, volumes = (int(x) for x in yf.split(","))
+
+        if year >= year_counts_start and year <= 2019:
+            match_counts[year - year_counts_start] = freq
+            volume_counts[year - year_counts_start] = volumes
+
+    return list_of_line_elements[0], match_counts, volume_counts
+
+
+def iter_line_blocks(f, block_size):
+    """Yields blocks of complete lines read from the binary file object f.
+    Each block ends with a newline and is around block_size bytes long."""
+
+    rest = b""
+
+    while True:
+
+        chunk = f.read(block_size)
+
+        if not chunk:
+            break
+
+        chunk = rest + chunk
+        cut = chunk.rfind(b"\n") + 1
+        rest = chunk[cut:]
+
+        if cut > 0:
+            yield chunk[:cut]
+
+    if rest:
+        yield rest + b"\n"
+
+
+def parse_uints(buf, starts):
+    """Parses the unsigned integers in the uint8 array buf starting at the
+    positions 'starts', all at once. Returns the integers and the positions
+    of the first non-digit character following each of them."""
+
+    values = np.zeros(len(starts), dtype=np.int64)
+    ends = starts.copy()
+    active = ends < len(buf)
+
+    while active.any():
+        digits = buf[np.minimum(ends, len(buf) - 1)] - ord("0")
+        active &= digits <= 9
+        values = np.where(active, values * 10 + digits, values)
+        ends += active
+        active &= ends < len(buf)
+
+    return values, ends
+
+
+def extract_block_sum_freqs(block):
+    """Batched version of 'extract_ngram_sum_freqs'.
+    Takes a block of complete lines of a .gz file as bytes and returns
+    arrays with the start and end position of the ngram in each line and
+    the sums of frequencies across each of the year_windows (one row per
+    window) for each line. If save_year_counts, also returns the line,
+    year, frequency and number of volumes of each element parsed,
+    otherwise None instead.
+    Returns None if the block is not formatted as expected."""
+
+    buf = np.frombuffer(block, dtype=np.uint8)
+
+    # positions of all tabs and newlines, in order
+    delims = np.flatnonzero((buf == ord("\t")) | (buf == ord("\n")))
+    is_newline = buf[delims] == ord("\n")
+    newlines = delims[is_newline]
+    tabs = delims[~is_newline]
+
+    # every tab starts an element "year,frequency,number_of_volumes"
+    field_line = (np.cumsum(is_newline) - is_newline)[~is_newline]
+    fields_per_line = np.bincount(field_line, minlength=len(newlines))
+    line_bounds = np.concatenate(([0], np.cumsum(fields_per_line)))
+
+    # the ngram runs from the start of each line to its first tab
+    line_starts = np.concatenate(([0], newlines[:-1] + 1))
+    ngram_ends = np.where(
+        fields_per_line > 0,
+        np.append(tabs, 0)[np.minimum(line_bounds[:-1], len(tabs))],
+        newlines)
+
+    # only the last max_relevant_year_freqs elements of a line can fall
+    # into year_windows, as in 'extract_ngram_sum_freqs'
+    relevant = (line_bounds[field_line + 1] - np.arange(len(tabs))
+                <= max_relevant_year_freqs)
+
+    years, year_ends = parse_uints(buf, tabs[relevant] + 1)
+    freqs, freq_ends = parse_uints(buf, year_ends + 1)
+
+    if not (np.all(year_ends > tabs[relevant] + 1)
+            and np.all(freq_ends > year_ends + 1)
+            and np.all(buf[year_ends] == ord(","))
+            and np.all(buf[freq_ends] == ord(","))):
+        return None
+
+    elements = None
+
+    if save_year_counts:
+
+        volumes, volume_ends = parse_uints(buf, freq_ends + 1)
+
+        if not (np.all(volume_ends > freq_ends + 1)
+                and np.all((buf[volume_ends] == ord("\t"))
+                           | (buf[volume_ends] == ord("\n")))):
+            return None
+
+        elements = (field_line[relevant], years, freqs, volumes)
+
+    sum_freqs = np.zeros((len(year_windows), len(newlines)), dtype=np.int64)
+
+    for w, (start, end) in enumerate(year_windows):
+
+        # sum freq within each line; the elements are ordered by line
+        cumfreqs = np.zeros(len(tabs) + 1, dtype=np.int64)
+        cumfreqs[1:][relevant] = np.where((years >= start) & (years <= end),
+                                          freqs, 0)
+        cumfreqs = np.cumsum(cumfreqs)
+        sum_freqs[w] = cumfreqs[line_bounds[1:]] - cumfreqs[line_bounds[:-1]]
+
+    return line_starts, ngram_ends, sum_freqs, elements
+
+
+def block_year_counts(elements, lines, nlines):
+    """Returns arrays of the match counts and numbers of volumes in each
+    year from year_counts_start to 2019 of the lines 'lines' of a block of
+    nlines lines, from its 'elements' as returned by
+    'extract_block_sum_freqs'."""
+
+    element_lines, years, freqs, volumes = elements
+
+    rows = np.full(nlines, -1)
+    rows[lines] = np.arange(len(lines))
+    element_rows = rows[element_lines]
+
+    use = (element_rows >= 0) & (years >= year_counts_start) & (years <= 2019)
+
+    match_counts = np.zeros((len(lines), year_counts_years), dtype=np.int64)
+    volume_counts = np.zeros((len(lines), year_counts_years), dtype=np.int32)
+    match_counts[element_rows[use], years[use] - year_counts_start] = \
+        freqs[use]
+    volume_counts[element_rows[use], years[use] - year_counts_start] = \
+        volumes[use]
+
+    return match_counts, volume_counts
+
+
+def concatenate_year_counts(counts):
+    """Concatenates a list of (match counts, volume counts) array pairs."""
+
+    return (np.concatenate([np.zeros((0, year_counts_years), dtype=np.int64)]
+                           + [c[0] for c in counts]),
+            np.concatenate([np.zeros((0, year_counts_years), dtype=np.int32)]
+                           + [c[1] for c in counts]))
+
+
+def select_top_k(ngrams, freqs, k, counts=None):
+    """Returns the k most frequent of the list 'ngrams', their frequencies
+    in the array 'freqs', and their rows of the year 'counts' if given,
+    keeping their order; among equally frequent ngrams those appearing
+    first are kept. Uses a partial selection instead of sorting."""
+
+    if k is None or len(freqs) <= k:
+        return ngrams, freqs, counts
+
+    # all ngrams more frequent than the k-th most frequent one, and the
+    # first of those exactly as frequent
+    kth_freq = np.partition(freqs, len(freqs) - k)[len(freqs) - k]
+    keep = freqs > kth_freq
+    keep[np.flatnonzero(freqs == kth_freq)[:k - np.count_nonzero(keep)]] = True
+    top = np.flatnonzero(keep)
+
+    if counts is not None:
+        counts = (counts[0][top], counts[1][top])
+
+    return [ngrams[i] for i in top], freqs[top], counts
+
+
+def get_ngrams_and_freqs_batched(f, n, stats, top_k):
+    """Batched version of 'get_ngrams_and_freqs'."""
+
+    ngrams = [list() for window in year_windows]
+    freqs = [list() for window in year_windows]
+    min_freqs = [min_freq_to_keep[n] for window in year_windows]
+
+    # year counts of the ngrams kept for the first window
+    counts = list() if save_year_counts else None
+
+    for block in iter_line_blocks(f, parse_block_size):
+
+        # carriage returns are line breaks in text mode, so leave such rare
+        # blocks, and any not formatted as expected, to the line by line parser
+        parsed = (None if b"\r" in block
+                  else extract_block_sum_freqs(block))
+
+        if parsed is None:
+            block_ngrams_and_freqs = get_ngrams_and_freqs(
+                io.BytesIO(block), n, batched=False, stats=stats, top_k=top_k)
+            for w, (block_ngrams, block_freqs, block_counts) in enumerate(
+                    block_ngrams_and_freqs):
+                ngrams[w] += block_ngrams
+                freqs[w] += [np.array(block_freqs, dtype=np.int64)]
+            if save_year_counts:
+                counts += [block_ngrams_and_freqs[0][2]]
+
+        else:
+            line_starts, ngram_ends, sum_freqs, elements = parsed
+            stats["lines"] += len(line_starts)
+
+            # exclude ngrams not frequent enough in any window
+            keep = np.flatnonzero(
+                (sum_freqs >= np.array(min_freqs)[:, None]).any(axis=0))
+
+            block_ngrams = [block[start:end].decode().lstrip() for start, end
+                            in zip(line_starts[keep], ngram_ends[keep])]
+
+            # lines starting with whitespace are stripped before being split
+            # in 'extract_ngram_sum_freqs', so handle these rare cases with it
+            blank = [j for j, ngram in enumerate(block_ngrams) if ngram == ""]
+            for j in blank:
+                line_end = block.index(b"\n", line_starts[keep[j]])
+                block_ngrams[j], sum_freqs[:, keep[j]] = \
+                    extract_ngram_sum_freqs(
+                        block[line_starts[keep[j]]:line_end].decode())
+
+            if save_year_counts:
+                kept = sum_freqs[0, keep] >= min_freqs[0]
+                block_counts = block_year_counts(
+                    elements, keep[kept], len(line_starts))
+                for j in [j for j in blank if kept[j]]:
+                    line_end = block.index(b"\n", line_starts[keep[j]])
+                    row = np.count_nonzero(kept[:j])
+                    line_counts = extract_ngram_year_counts(
+                        block[line_starts[keep[j]]:line_end].decode())
+                    block_counts[0][row] = line_counts[1]
+                    block_counts[1][row] = line_counts[2]
+                counts += [block_counts]
+
+            for w in range(len(year_windows)):
+                kept = sum_freqs[w, keep] >= min_freqs[w]
+                ngrams[w] += [ngram for ngram, k in zip(block_ngrams, kept)
+                              if k]
+                freqs[w] += [sum_freqs[w, keep][kept]]
+
+        # keep a buffer of at most twice the top_k most frequent ngrams;
+        # later ngrams not more frequent than the top_k-th can then be
+        # excluded, as the earlier ones are kept among equally frequent
+        for w in range(len(year_windows)):
+            if top_k is not None and len(ngrams[w]) > 2 * top_k:
+                window_counts = None
+                if save_year_counts and w == 0:
+                    window_counts = concatenate_year_counts(counts)
+                ngrams[w], freqs[w], window_counts = select_top_k(
+                    ngrams[w], np.concatenate(freqs[w]), top_k,
+                    window_counts)
+                min_freqs[w] = max(min_freqs[w], freqs[w].min() + 1)
+                freqs[w] = [freqs[w]]
+                if save_year_counts and w == 0:
+                    counts = [window_counts]
+
+    return [select_top_k(ngrams[w],
+                         np.concatenate([np.zeros(0, dtype=np.int64)]
+                                        + freqs[w]),
+                         top_k,
+                         concatenate_year_counts(counts)
+                         if save_year_counts and w == 0 else None)
+            for w in range(len(year_windows))]
+
+
+def get_ngrams_and_freqs(f, n, batched=None, stats=None, top_k=None):
+    """Get lists of the ngrams and their frequencies from the open binary
+    .gz file object f, excluding ngrams less frequent than min_freq_to_keep,
+    for each of the year_windows, as a list of (ngrams, freqs, counts)
+    tuples. If save_year_counts, counts of the first window is a tuple of
+    arrays of the match counts and numbers of volumes of its ngrams in each
+    year from year_counts_start to 2019, one row per ngram, otherwise None.
+    Uses the batched parser if 'batched' (default: use_batched_parser).
+    The number of lines read is added to the dictionary 'stats', if
+    given.
+    If 'top_k' is given, only the top_k most frequent ngrams are kept,
+    using memory proportional to top_k; among equally frequent ngrams
+    those appearing first are kept."""
+
+    if batched is None:
+        batched = use_batched_parser
+
+    if stats is None:
+        stats = dict()
+    stats.setdefault("lines", 0)
+
+    if batched:
+        return get_ngrams_and_freqs_batched(f, n, stats, top_k)
+
+    ngrams = [list() for window in year_windows]
+    freqs = [list() for window in year_windows]
+    counts = [list() for window in year_windows]
+
+    # min-heaps of (freq, -line number, ngram, year counts)
+    # for the top_k most frequent
+    heaps = [list() for window in year_windows]
+
+    for i, line in enumerate(io.TextIOWrapper(f)):
+
+        stats["lines"] += 1
+
+        ngram, sum_freqs = extract_ngram_sum_freqs(line)
+
+        for w, freq in enumerate(sum_freqs):
+
+            # exclude ngrams not frequent enough
+            if freq >= min_freq_to_keep[n]:
+                line_counts = None
+                if save_year_counts and w == 0:
+                    line_counts = extract_ngram_year_counts(line)[1:]
+                if top_k is None:
+                    ngrams[w] += [ngram]
+                    freqs[w] += [freq]
+                    counts[w] += [line_counts]
+                elif len(heaps[w]) < top_k:
+                    heapq.heappush(heaps[w], (freq, -i, ngram, line_counts))
+                elif (freq, -i) > heaps[w][0][:2]:
+                    heapq.heapreplace(heaps[w],
+                                      (freq, -i, ngram, line_counts))
+
+    if top_k is not None:
+        for w, heap in enumerate(heaps):
+            heap.sort(key=lambda x: -x[1])
+            ngrams[w] = [x[2] for x in heap]
+            freqs[w] = [x[0] for x in heap]
+            counts[w] = [x[3] for x in heap]
+
+    if save_year_counts:
+        counts[0] = (
+            np.array([c[0] for c in counts[0]], dtype=np.int64).reshape(
+                -1, year_counts_years),
+            np.array([c[1] for c in counts[0]], dtype=np.int32).reshape(
+                -1, year_counts_years))
+
+    return [(ngrams[w], freqs[w],
+             counts[w] if save_year_counts and w == 0 else None)
+            for w in range(len(year_windows))]
+
+
+class ZlibGzipReader(io.RawIOBase):
+    """Reads the decompressed data of the (possibly multi-member) gzip file
+    object fileobj, decompressing decompression_buffer_size compressed bytes
+    at a time with zlib directly."""
+
+    def __init__(self, fileobj, close_fileobj=False):
+        self.fileobj = fileobj
+        self.close_fileobj = close_fileobj
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.in_member = False
+        self.pending = memoryview(b"")
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, b):
+
+        while len(self.pending) == 0:
+
+            if self.decompressor.eof:
+                # continue with the next gzip member, if any
+                chunk = (self.decompressor.unused_data
+                         or self.fileobj.read(decompression_buffer_size))
+                self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self.in_member = False
+            else:
+                chunk = self.fileobj.read(decompression_buffer_size)
+
+            if not chunk:
+                if self.in_member:
+                    raise EOFError("Compressed file ended before the "
+                                   "end-of-stream marker was reached")
+                return 0
+
+            self.in_member = True
+            self.pending = memoryview(self.decompressor.decompress(chunk))
+
+        nbytes = min(len(b), len(self.pending))
+        b[:nbytes] = self.pending[:nbytes]
+        self.pending = self.pending[nbytes:]
+        self.position += nbytes
+
+        return nbytes
+
+    def close(self):
+        if self.close_fileobj:
+            self.fileobj.close()
+        super().close()
+
+
+class PigzReader(io.RawIOBase):
+    """Reads the decompressed data of the .gz file at path from the external
+    pigz program."""
+
+    def __init__(self, path):
+        self.process = subprocess.Popen(["pigz", "-dc", path],
+                                        stdout=subprocess.PIPE)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, b):
+        nbytes = self.process.stdout.readinto(b)
+        self.position += nbytes
+        return nbytes
+
+    def close(self):
+        if not self.closed:
+            self.process.stdout.close()
+            if self.process.wait() != 0:
+                raise OSError("pigz failed with exit code "
+                              f"{self.process.returncode}")
+        super().close()
+
+
+def open_gz(source, backend=None):
+    """Opens the .gz file at the path, or in the binary file object, 'source'
+    for reading its decompressed data in binary mode, using 'backend'
+    (default: decompression_backend); see the settings for the options."""
+
+    if backend is None:
+        backend = decompression_backend
+
+    if backend == "gzip":
+        return gzip.open(source, 'rb')
 
-        gz_file_stream = urlopen(gz_file_url, timeout=60)
+    if backend == "isal" and igzip is not None:
+        return igzip.open(source, 'rb')
 
-        with gzip.open(gz_file_stream, 'rt') as f:
+    if (backend == "pigz" and isinstance(source, str)
+        and shutil.which("pigz") is not None):
+        return io.BufferedReader(PigzReader(source), 2**20)
 
-            for line in f:
+    if isinstance(source, str):
+        return io.BufferedReader(
+            ZlibGzipReader(open(source, 'rb'), close_fileobj=True), 2**20)
 
-                ngram, freq = extract_ngram_sum_freq(line)
+    return io.BufferedReader(ZlibGzipReader(source), 2**20)
 
-                # exclude ngrams not frequent enough
-                if freq >= min_freq_to_keep[n]:
-                    ngrams += [ngram]
-                    freqs += [freq]
 
-        # create dataframe, sort, and save to csv
+def get_most_freq_dfs(f, n, batched=None, stats=None, top_k=None):
+    """Returns a list of dataframes of the ngrams in the open binary .gz
+    file object f and their frequencies, sorted by decreasing frequency,
+    one for each of the year_windows, and the year counts of the ngrams
+    of the first one in the same order, or None if not save_year_counts.
+    See 'get_ngrams_and_freqs' for 'batched', 'stats', and 'top_k'."""
+
+    dfs = list()
+    year_counts = None
+
+    for ngrams, freqs, counts in get_ngrams_and_freqs(f, n, batched, stats,
+                                                      top_k):
+
+        # create dataframe and sort
 
         df = pd.DataFrame({'ngram': ngrams,
                            'freq': freqs})
 
-        df = df.sort_values(by=['freq'], ascending=False)
+        # the full list is sorted as before, so that its csv-file stays
+        # byte-identical; the top_k kept are sorted stably, so that equally
+        # frequent ngrams stay in file order
+        if top_k is None:
+            df = df.sort_values(by=['freq'], ascending=False)
+        else:
+            df = df.sort_values(by=['freq'], ascending=False, kind='stable')
+
+        if counts is not None:
+            year_counts = (counts[0][df.index], counts[1][df.index])
+
+        dfs += [df]
+
+    return dfs, year_counts
+
+
+def get_most_freq_df(f, n, batched=None, stats=None, top_k=None):
+    """Returns a dataframe of the ngrams in the open binary .gz file object f
+    and their frequencies from year_start to year_end, sorted by decreasing
+    frequency. See 'get_ngrams_and_freqs' for 'batched', 'stats', and
+    'top_k'."""
+
+    return get_most_freq_dfs(f, n, batched, stats, top_k)[0][0]
+
+
+def write_per_gz_file_bin(df, path):
+    """Writes df in the binary format read by gather_and_clean.py: the magic
+    bytes 'per_gz_file_magic', the number of rows and the size of each
+    frequency in bytes as little-endian int64, the frequencies as unsigned
+    int32 if they all fit, otherwise as int64, and finally the ngrams as
+    UTF-8, each followed by a newline."""
+
+    freqs = df['freq'].to_numpy()
+    if freqs.size == 0 or freqs.max() < 2**32:
+        freqs = freqs.astype('<u4')
+    else:
+        freqs = freqs.astype('<i8')
+
+    with open(path, 'wb') as f:
+        f.write(per_gz_file_magic)
+        f.write(np.array([freqs.size, freqs.itemsize], dtype='<i8')
+                .tobytes())
+        f.write(freqs.tobytes())
+        f.write("".join(ngram + "\n" for ngram in df['ngram'])
+                .encode('utf-8'))
+
+
+def save_per_gz_file(df, lang, gz_file_url, stats, window=None):
+    """Save df as the list of most frequent ngrams of one .gz file, for the
+    year window 'window' if given.
+    The list is written to a temporary file first and then renamed, so that
+    a list which exists is always complete. Adds the number of rows, the
+    output path, and its checksum to 'stats'."""
+
+    path = per_gz_file_path(lang, window)
+    outfile = path + '/' + per_gz_file_name(gz_file_url)
+    tmpfile = path + '/.tmp_' + per_gz_file_name(gz_file_url)
+
+    if per_gz_file_format == "bin":
+        write_per_gz_file_bin(df, tmpfile)
+    else:
+        df.to_csv(tmpfile, index=False)
+
+    with open(tmpfile, 'rb') as f:
+        stats["sha256"] = hashlib.sha256(f.read()).hexdigest()
+    stats["rows"] = df.shape[0]
+    stats["output"] = outfile
+
+    os.replace(tmpfile, outfile)
+
 
-        df.to_csv(f"{per_gz_file_path(lang)}/ngrams_"
-                  f"{gz_file_url.split(sep='/')[-1]}.csv", index=False)
+def save_per_gz_files(dfs, lang, gz_file_url, stats):
+    """Save the lists of most frequent ngrams of one .gz file for each of
+    the year_windows. The stats of those for extra_year_windows are added
+    to 'stats' under "windows"."""
+
+    save_per_gz_file(dfs[0], lang, gz_file_url, stats)
+
+    for df, window in zip(dfs[1:], extra_year_windows):
+        window_stats = dict()
+        save_per_gz_file(df, lang, gz_file_url, window_stats, window)
+        stats.setdefault("windows", dict())[f"{window[0]}-{window[1]}"] = \
+            window_stats
+
+
+def save_per_gz_file_year_counts(year_counts, lang, gz_file_url, stats):
+    """Save the match counts and numbers of volumes in each year from
+    year_counts_start to 2019 of the most frequent ngrams of one .gz file,
+    one row per ngram in the order of its list, as .npy files.
+    The match counts are saved as unsigned int32 if they all fit, otherwise
+    as int64, the numbers of volumes as int32. Adds the output paths to
+    'stats'."""
+
+    match_counts, volume_counts = year_counts
+    if match_counts.size == 0 or match_counts.max() < 2**32:
+        match_counts = match_counts.astype('<u4')
+
+    stats["year_counts"] = list()
+
+    for suffix, counts in [("match_counts", match_counts),
+                           ("volume_counts", volume_counts)]:
+
+        path = year_counts_path(lang)
+        name = f"{gz_file_url.split(sep='/')[-1]}.{suffix}.npy"
+
+        with open(path + '/.tmp_' + name, 'wb') as f:
+            np.save(f, counts)
+
+        os.replace(path + '/.tmp_' + name, path + '/' + name)
+        stats["year_counts"] += [path + '/' + name]
+
+
+def load_year_counts(lang, gz_file_url):
+    """Returns the match counts and numbers of volumes in each year saved
+    for the .gz file at gz_file_url (see save_year_counts), memory-mapped.
+    Column i is year year_counts_start + i."""
+
+    path = year_counts_path(lang)
+    name = gz_file_url.split(sep='/')[-1]
+
+    return (np.load(f"{path}/{name}.match_counts.npy", mmap_mode='r'),
+            np.load(f"{path}/{name}.volume_counts.npy", mmap_mode='r'))
+
+
+def sum_year_counts(counts, first_year, last_year):
+    """Returns the sums of the year counts 'counts' from first_year to
+    last_year for each ngram."""
+
+    return counts[:, max(first_year - year_counts_start, 0):
+                  max(last_year - year_counts_start + 1, 0)].sum(
+        axis=1, dtype=np.int64)
+
+
+# persistent HTTP connections of each thread, by scheme and host
+http_connections = threading.local()
+
+def get_http_connection(url):
+    """Returns this thread's persistent connection to the host of url."""
+
+    scheme, host = urlsplit(url)[:2]
+    pool = http_connections.__dict__.setdefault("pool", dict())
+
+    if (scheme, host) not in pool:
+        if scheme == "https":
+            pool[(scheme, host)] = http.client.HTTPSConnection(host,
+                                                               timeout=60)
+        else:
+            pool[(scheme, host)] = http.client.HTTPConnection(host,
+                                                              timeout=60)
+
+    return pool[(scheme, host)]
+
+
+def drop_http_connection(url):
+    """Closes this thread's connection to the host of url, if any."""
+
+    scheme, host = urlsplit(url)[:2]
+    pool = http_connections.__dict__.setdefault("pool", dict())
+
+    if (scheme, host) in pool:
+        pool.pop((scheme, host)).close()
+
+
+def request_from_offset(url, offset):
+    """Requests url from byte 'offset' on over a persistent connection.
+    Returns the response, the offset at which its body starts, which is 0
+    if the server ignores the range, and the total size of the file."""
+
+    for redirect in range(10):
+
+        parts = urlsplit(url)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        headers = {"Range": f"bytes={offset}-"} if offset > 0 else dict()
+
+        connection = get_http_connection(url)
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+        except Exception:
+            drop_http_connection(url)
+            raise
+
+        if response.status in (301, 302, 303, 307, 308):
+            response.read()
+            url = urljoin(url, response.getheader("Location"))
+            continue
+
+        if response.status == 206:
+            total = int(response.getheader("Content-Range").split("/")[-1])
+            return response, offset, total
+
+        if response.status == 200:
+            return response, 0, response.length
+
+        # the file was already read completely
+        if response.status == 416 and offset > 0:
+            response.read()
+            return None, offset, offset
+
+        response.read()
+        raise HTTPError(url, response.status, response.reason,
+                        response.headers, None)
+
+    raise http.client.HTTPException(f"Too many redirects: {url}")
+
+
+class ResumableHTTPStream(io.RawIOBase):
+    """Read-only binary stream of the file at url, starting at byte 'offset'.
+    If the connection fails, the stream reconnects and continues from the
+    byte it stopped at using an HTTP Range request, retrying up to
+    download_retries times with exponential backoff. The retries are only
+    available again once the stream got download_retry_reset_bytes past
+    the byte where it last failed. Hence a gzip decompressor reading from
+    it continues where it was, instead of starting over. Connections are
+    kept open and reused per thread."""
+
+    def __init__(self, url, offset=0):
+        self.url = url
+        self.offset = offset
+        self.length = None   # total size of the file, once known
+        self.response = None
+        self.retries = 0     # retries since the stream last got far enough
+        self.failed_at = offset
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+
+        while True:
+
+            try:
+                if self.response is None:
+                    if self.length is not None and self.offset >= self.length:
+                        return 0
+                    self.response, start, self.length = \
+                        request_from_offset(self.url, self.offset)
+                    if self.response is None:
+                        return 0
+                    # skip what was already read if the range was ignored
+                    while start < self.offset:
+                        skipped = self.response.read(
+                            min(self.offset - start, 2**20))
+                        if not skipped:
+                            raise http.client.IncompleteRead(b"")
+                        start += len(skipped)
+
+                nbytes = self.response.readinto(b)
+
+                if nbytes == 0 and len(b) > 0:
+                    self.response = None
+                    if self.length is None or self.offset >= self.length:
+                        return 0
+                    raise http.client.IncompleteRead(b"", self.length
+                                                     - self.offset)
+
+                self.offset += nbytes
+                if (self.offset - self.failed_at
+                    >= download_retry_reset_bytes):
+                    self.retries = 0
+                return nbytes
+
+            except (OSError, http.client.HTTPException) as e:
+                self.response = None
+                drop_http_connection(self.url)
+                # client errors like a missing file are not retried
+                if (self.retries == download_retries
+                    or (isinstance(e, HTTPError) and e.code < 500)):
+                    raise
+                print(f"retrying {self.url.split(sep='/')[-1]} from byte "
+                      f"{self.offset} after error: {e!r}")
+                time.sleep(download_backoff * 2**self.retries)
+                self.retries += 1
+                self.failed_at = self.offset
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+        super().close()
+
+
+def get_most_freq_from_gz_file2(gz_file_url, lang, n):
+
+    stats = dict()
+    start = timer()
+
+    try:
+        gz_file_stream = io.BufferedReader(ResumableHTTPStream(gz_file_url),
+                                           2**20)
+
+        # closes the connection also if reading fails
+        with gz_file_stream, open_gz(gz_file_stream) as f:
+            dfs, year_counts = get_most_freq_dfs(
+                f, n, stats=stats, top_k=per_file_top_k(lang, n))
+            stats["decompressed_bytes"] = f.tell()
+
+        stats["compressed_bytes"] = gz_file_stream.raw.offset
+
+        # save to csv
+        save_per_gz_files(dfs, lang, gz_file_url, stats)
+        if save_year_counts:
+            save_per_gz_file_year_counts(year_counts, lang, gz_file_url,
+                                         stats)
+
+        stats["seconds"] = timer() - start
+        record_in_manifest(gz_file_url, lang, n, "done", stats)
 
     except Exception as e:
+        record_in_manifest(gz_file_url, lang, n, "failed", error=e)
         if continue_on_exception:
             print(f"ERROR: file {gz_file_url.split(sep='/')[-1]} not handled")
             print(e)
         else:
             raise e   # TODO doesn't work as expected
 
+    return stats
+
 
 
 def get_most_freq_from_gz_file(gz_file_path, lang, n):
-    """Get the most frequent ngrams from one .gz file and save as .csv file."""
+    """Get the most frequent ngrams from one .gz file and save as .csv file.
+    Returns the number of lines read, the sizes of the
+    file, and the number of rows and checksum of the .csv file."""
 
-    # read file line by line and collect lists of ngrams and frequencies
+    stats = dict()
+    stats["compressed_bytes"] = os.path.getsize(gz_file_path)
 
-    ngrams = list()
-    freqs = list()
+    with open_gz(gz_file_path) as f:
+        dfs, year_counts = get_most_freq_dfs(
+            f, n, stats=stats, top_k=per_file_top_k(lang, n))
+        stats["decompressed_bytes"] = f.tell()
 
-    with gzip.open(gz_file_path, 'rt') as f:
+    # save to csv
+    save_per_gz_files(dfs, lang, gz_file_path, stats)
+    if save_year_counts:
+        save_per_gz_file_year_counts(year_counts, lang, gz_file_path, stats)
 
-        for line in f:
+    return stats
 
-            ngram, freq = extract_ngram_sum_freq(line)
 
-            # exclude ngrams not frequent enough
-            if freq >= min_freq_to_keep[n]:
-                ngrams += [ngram]
-                freqs += [freq]
+def record_in_manifest(gz_file_url, lang, n, state, stats=None, error=None):
+    """Append the state ("done" or "failed") of one .gz file, together with
+    'stats' or the 'error', to the manifest, if use_manifest."""
+
+    if not use_manifest:
+        return
+
+    entry = {"url": gz_file_url, "lang": lang, "n": n, "state": state,
+             "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+    entry.update(stats or dict())
+    if error is not None:
+        entry["error"] = repr(error)
+
+    with manifest_lock:
+        with open(manifest_path(), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
 
-    # create dataframe, sort, and save to csv
 
-    df = pd.DataFrame({'ngram': ngrams,
-                       'freq': freqs})
+def read_manifest():
+    """Returns a dictionary with the latest manifest entry of each url."""
 
-    df = df.sort_values(by=['freq'], ascending=False)
+    entries = dict()
 
-    df.to_csv(f"{per_gz_file_path(lang)}/ngrams_"
-              f"{gz_file_path.split(sep='/')[-1]}.csv", index=False)
+    if not os.path.exists(manifest_path()):
+        return entries
+
+    with open(manifest_path(), encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue   # last line cut off by a crash
+            entries[entry["url"]] = entry
+
+    return entries
 
 
 def download_and_process_one_gz_file(gz_file_url, lang, n):
@@ -287,9 +1253,11 @@ def download_and_process_one_gz_file(gz_file_url, lang, n):
     # process the file
     print("processing...")
     start = timer()
-    get_most_freq_from_gz_file(gz_file_path, lang, n)
+    stats = get_most_freq_from_gz_file(gz_file_path, lang, n)
     end = timer()
     print(f"processing time: {round(end - start, 2)}s")
+    stats["seconds"] = end - start
+    record_in_manifest(gz_file_url, lang, n, "done", stats)
 
     # remove file after to save space
     os.remove(gz_file_path)
@@ -321,6 +1289,18 @@ def download_and_process_one_gz_file2(lang, n, urls, i):
     #os.remove(gz_file_path)
 
 
+def add_existing_per_gz_files_to_manifest(lang, n, urls):
+    """Add the lists of most frequent ngrams of .gz files in 'urls' already
+    in per_gz_file_path to the manifest as done."""
+
+    existing = set(os.listdir(per_gz_file_path(lang)))
+
+    for url in urls:
+        if per_gz_file_name(url) in existing:
+            record_in_manifest(url, lang, n, "done", {"output": (
+                per_gz_file_path(lang) + '/' + per_gz_file_name(url))})
+
+
 def get_urls(lang, n):
     """Returns a list of urls from which to actually download a file."""
 
@@ -333,12 +1313,23 @@ def get_urls(lang, n):
     if use_custom_url_indices:
         urls = [urls[i] for i in custom_url_indices[lang][n]]
 
-    if not redownload_files:
+    if not redownload_files and use_manifest:
+        manifest = read_manifest()
+
+        # files handled before the manifest existed are added to it once
+        if not any(url in manifest for url in urls):
+            add_existing_per_gz_files_to_manifest(lang, n, urls)
+            manifest = read_manifest()
+
+        urls = [url for url in urls
+                if manifest.get(url, dict()).get("state") != "done"]
+
+    elif not redownload_files:
         urls_already_downloaded = os.listdir(per_gz_file_path(lang))
-        p = re.compile(f"^ngrams_{n}-.*\.gz\.csv")
+        p = re.compile(f"^ngrams_{n}-.*\.gz\.{per_gz_file_format}")
         urls_already_downloaded = \
             [s for s in urls_already_downloaded if p.match(s)]
-        urls_short = ["ngrams_" + url.split("/")[-1] + ".csv" for url in urls]
+        urls_short = [per_gz_file_name(url) for url in urls]
 
         urls = [urls[i] for i in range(len(urls_short))
                 if urls_short[i] not in urls_already_downloaded]
@@ -394,11 +1385,192 @@ def download_and_process_each_gz_file_mp():
                     for i in range(len(urls)):
                         download_and_process_one_gz_file2(lang, n, urls, i)
 
-        os.rmdir(tmp_path(lang))
+        remove_tmp_path(lang)
+
+
+def download_gz_file(gz_file_url, gz_file_path):
+    """Download one .gz file to gz_file_path. If part of it is already
+    there from an earlier attempt, only the remainder is downloaded."""
+
+    offset = 0
+    if os.path.exists(gz_file_path):
+        offset = os.path.getsize(gz_file_path)
+
+    with ResumableHTTPStream(gz_file_url, offset) as stream:
+        with open(gz_file_path, 'ab') as f:
+            shutil.copyfileobj(stream, f, 2**20)
+
+
+def remove_tmp_path(lang):
+    """Removes the folder of the downloaded .gz files of lang if it is
+    empty. Otherwise lists the partially downloaded files left in it by
+    failed downloads, which are continued when downloaded again."""
+
+    path = f"ngrams/more/{lang}/tmp"
+
+    if not os.path.exists(path):
+        return
+
+    if os.listdir(path):
+        print(f"partially downloaded files kept in {path}: "
+              + ", ".join(sorted(os.listdir(path))))
+    else:
+        os.rmdir(path)
+
+
+def process_downloaded_gz_file(gz_file_path, lang, n):
+    """Process one downloaded .gz file and remove it.
+    Returns the number of lines read, and the processing time."""
+
+    start = timer()
+
+    try:
+        stats = get_most_freq_from_gz_file(gz_file_path, lang, n)
+    finally:
+        os.remove(gz_file_path)
+
+    stats["seconds"] = timer() - start
+
+    return stats
+
+
+def download_and_process_gz_files_scheduled(jobs):
+    """Download and process the .gz-files in 'jobs', a list of tuples
+    (lang, n, url), using one scheduler across all languages and n's.
+    Up to max_connections files are downloaded at once in threads and the
+    downloaded files are processed by number_of_cores processes; the
+    downloaded files waiting for a free process are held in a queue of
+    size max_queued_files, so that neither the network nor the cores idle
+    as long as there is work.
+    Output: raw, uncleaned .csv files of the most frequent n-grams.
+    """
+
+    downloaded = queue.Queue(max_queued_files or 2 * number_of_cores)
+    free_cores = threading.Semaphore(number_of_cores)
+    stop = threading.Event()
+    errors = list()
+    finished = list()
+
+    def download(lang, n, gz_file_url):
+        # always put one entry into the queue, which the main thread
+        # waits for
+        gz_file_path = None
+        error = None
+        try:
+            if not stop.is_set():
+                gz_file_path = (tmp_path(lang) + '/'
+                                + gz_file_url.split(sep="/")[-1])
+                download_gz_file(gz_file_url, gz_file_path)
+        except BaseException as e:
+            # a partially downloaded file is kept to be resumed next time,
+            # if keep_partial_downloads
+            if (gz_file_path is not None and not keep_partial_downloads
+                and os.path.exists(gz_file_path)):
+                os.remove(gz_file_path)
+            gz_file_path = None
+            error = e
+        downloaded.put((lang, n, gz_file_url, gz_file_path, error))
+
+    def report(lang, n, gz_file_url, future):
+        free_cores.release()
+        if future.exception() is not None:
+            handle_error(lang, n, gz_file_url, future.exception())
+            return
+        finished.append(gz_file_url)
+        record_in_manifest(gz_file_url, lang, n, "done", future.result())
+        print((f"finished: lang={lang}, n={n}, "
+               f"file {gz_file_url.split(sep='/')[-1]} "
+               f"({len(finished)} of {len(jobs)}): "
+               f"{round(future.result()['seconds'], 2)}s"))
+
+    def handle_error(lang, n, gz_file_url, e):
+        record_in_manifest(gz_file_url, lang, n, "failed", error=e)
+        print(f"ERROR: file {gz_file_url.split(sep='/')[-1]} not handled")
+        print(e)
+        errors.append(e)
+        if not continue_on_exception:
+            stop.set()
+
+    io_pool = ThreadPoolExecutor(max_connections)
+    cpu_pool = ProcessPoolExecutor(number_of_cores)
+    downloads = list()
+    received = 0
+
+    try:
+        for lang, n, gz_file_url in jobs:
+            downloads += [io_pool.submit(download, lang, n, gz_file_url)]
+
+        while received < len(jobs):
+
+            lang, n, gz_file_url, gz_file_path, e = downloaded.get()
+            received += 1
+
+            if e is not None:
+                handle_error(lang, n, gz_file_url, e)
+
+            if gz_file_path is None:
+                continue
+
+            free_cores.acquire()
+
+            if stop.is_set():
+                free_cores.release()
+                os.remove(gz_file_path)
+                continue
+
+            future = cpu_pool.submit(process_downloaded_gz_file,
+                                     gz_file_path, lang, n)
+            future.add_done_callback(partial(report, lang, n, gz_file_url))
+
+    finally:
+        if received < len(jobs):
+            # stopped by an exception here: start no further downloads or
+            # processes, and empty the queue until the running downloads
+            # are done, so that none of them waits for space in it; the
+            # files downloaded are kept to be resumed next time, if
+            # keep_partial_downloads
+            stop.set()
+            for future in downloads:
+                future.cancel()
+            while (not all(future.done() for future in downloads)
+                   or not downloaded.empty()):
+                try:
+                    gz_file_path = downloaded.get(timeout=0.1)[3]
+                except queue.Empty:
+                    continue
+                if gz_file_path is not None and not keep_partial_downloads:
+                    os.remove(gz_file_path)
+            cpu_pool.shutdown(cancel_futures=True)
+        io_pool.shutdown()
+        cpu_pool.shutdown()
+
+    if errors and not continue_on_exception:
+        raise errors[0]
+
+    return finished
+
+
+def download_and_process_all_gz_files(jobs=None):
+    """Download and process .gz-files for all languages in 'langs' and n in
+    'ns' at once, or the .gz-files in 'jobs' if given, and remove the tmp
+    folders left empty. See 'download_and_process_gz_files_scheduled'.
+    """
+
+    if jobs is None:
+        jobs = [(lang, n, url) for lang in langs for n in ns
+                for url in get_urls(lang, n)]
+
+    finished = download_and_process_gz_files_scheduled(jobs)
+
+    # failed downloads are kept to be resumed, see keep_partial_downloads
+    for lang in sorted(set(lang for lang, n, url in jobs)):
+        remove_tmp_path(lang)
+
+    return finished
 
 
 ###############################################################################
 # Run
 
 if __name__ == '__main__':
-    download_and_process_each_gz_file_mp()
+    download_and_process_all_gz_files()
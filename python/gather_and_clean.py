@@ -3,9 +3,22 @@
 from cmath import nan
 import pandas as pd
 import numpy as np
+import hashlib
+import inspect
+import io
+import itertools
+import json
 import os
 import re
 import math
+import shutil
+import sys
+import multiprocessing as mp
+from timeit import default_timer as timer
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 
 ###############################################################################
@@ -17,6 +30,12 @@ ns = [1, 2, 3, 4, 5]
 year_start = 2010
 year_end = 2019
 
+# Gather the lists of most frequent ngrams per .gz file extracted for one
+# of the extra_year_windows set in download_and_extract_most_freq.py, e.g.
+# (2000, 2009), instead of those for year_start to year_end there;
+# year_start and year_end above should then be set to this window
+per_gz_file_window = None
+
 # List of languages for which frequency lists should be extracted
 langs = ["chinese_simplified", "english", "english-fiction", "french",
          "german", "hebrew", "italian", "russian", "spanish"]
@@ -44,7 +63,7 @@ number_of_most_freq = {"chinese_simplified":
                        "spanish":
                        {1: 10000, 2: 5000, 3: 3000, 4: 1000, 5: 1000}}
 
-# Number of most frequent ngrams to keep per file
+# Number of most frequent ngrams to keep per file (unless adaptive_gather)
 per_file_number_of_most_freq = {"chinese_simplified":
                                 {1: 40000, 2: 25000, 3: 25000, 4: 25000,
                                  5: 25000},
@@ -73,6 +92,61 @@ per_file_number_of_most_freq = {"chinese_simplified":
                                 {1: 25000, 2: 5000, 3: 3000, 4: 3000,
                                  5: 5000}}
 
+# The lists of most frequent ngrams per .gz file are merged one frequency
+# band at a time (see PerGzFileMerger); stop after this many times
+# number_of_most_freq ngrams, which is enough if not too many of them are
+# removed while cleaning (checked by check_if_too_much_truncated); with None
+# all rows read per file are kept, as before, since how many are removed
+# varies a lot: from a third of them for 1grams to 99% for some 5grams
+gather_rows_factor = None
+
+# Read each list of most frequent ngrams per .gz file only as deep as
+# needed instead of per_file_number_of_most_freq rows: start by merging
+# gather_rows_factor (2 if None) times number_of_most_freq ngrams and, if
+# too many of them are removed while cleaning, merge on to twice as many,
+# reading each file on from where it stopped; the result is exact as long
+# as min_freq_to_keep was low enough
+adaptive_gather = False
+
+# Number of rows first read at once from each list of most frequent ngrams
+# per .gz file while merging them with a gather_rows_factor; doubles with
+# each further read up to gather_max_chunk_rows
+gather_chunk_rows = 256
+gather_max_chunk_rows = 2**16
+
+# Gather and clean all ns of a language with contractions (see
+# langs_with_contractions) in one job, adding the ngrams which get more
+# words when splitting contractions to the list of the n they then have,
+# instead of only using those of 1grams (to add their parts to the 1grams)
+cross_n_pipeline = False
+
+# Number of (lang, n) combinations to gather and clean in parallel; each
+# job holds its lists in memory, so check the peak memory printed per job
+# before raising it
+# number_of_cores = max(mp.cpu_count() - 2, 1)
+number_of_cores = 1
+
+# Format of the lists of most frequent ngrams per .gz file, "csv" or "bin";
+# should be the same as in download_and_extract_most_freq.py
+per_gz_file_format = "csv"
+
+# Only gather and clean the (lang, n) whose inputs changed since they were
+# last gathered and cleaned: the lists of most frequent ngrams per .gz
+# file, the extra settings, the settings above, and this script (see
+# job_fingerprint); moreover reuse the gathered ngrams without POS tags if
+# only later steps changed (see cache_gathered)
+incremental_rebuild = False
+
+# Cache the merged lists of most frequent ngrams per .gz file, with POS
+# tags removed if cache_gathered_without_pos, for the truncation settings
+# above, in ngrams/more/{lang}/cache, a folder that can be deleted any time,
+# so that running gather_and_clean again, e.g. after changing the cleaning
+# rules, does not merge them again; the cache is not used once the lists
+# per .gz file change (see gather_stage_fingerprint), and is replaced when
+# they are merged again
+cache_gathered = False
+cache_gathered_without_pos = True
+
 
 ###############################################################################
 # Constants etc.
@@ -80,6 +154,9 @@ per_file_number_of_most_freq = {"chinese_simplified":
 all_langs = ["chinese_simplified", "english", "english-fiction", "french",
              "german", "hebrew", "italian", "russian", "spanish"]
 
+# languages in which contractions like qu'il are split into several words
+langs_with_contractions = ["french", "italian"]
+
 langcode = {"english": "eng", "english-us": "eng-us", "english-gb": "eng-gb", 
             "english-fiction": "eng-fiction", "chinese_simplified": "chi_sim", 
             "french": "fre", "german": "ger", "hebrew": "heb", 
@@ -104,6 +181,16 @@ extra_ngrams_to_exclude = \
          for key in extra_ngrams_to_exclude[n]}
      for n in extra_ngrams_to_exclude}
 
+# first bytes of each list of most frequent ngrams in the "bin" format;
+# should be the same as in download_and_extract_most_freq.py
+per_gz_file_magic = b"NGRAMS1\n"
+
+# strings pd.read_csv reads as missing by default; the "bin" reader treats
+# them the same, so that both formats give identical results
+default_na_strings = {"", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN",
+                      "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A",
+                      "NA", "NULL", "NaN", "None", "n/a", "nan", "null"}
+
 def totalcounts_1_file(lang):
     return (f"source-data/data_googlebooks-{langcode[lang]}"
             + "-20200217/totalcounts_1.txt")
@@ -117,61 +204,349 @@ def tmp_path(lang):
 
     return path
 
+def cache_path(lang):
+
+    path = f"ngrams/more/{lang}/cache"
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    return path
+
 def per_gz_file_path(lang):
 
     path = f"ngrams/more/{lang}/most_freq_ngrams_per_gz_file"
 
+    if per_gz_file_window is not None:
+        path += f"_{per_gz_file_window[0]}-{per_gz_file_window[1]}"
+
     if not os.path.exists(path):
         os.makedirs(path)
 
     return path
 
-def check_if_too_much_truncated(lang, n, d):
+def per_gz_files(lang, n):
+    """Returns the sorted names of the lists of most frequent ngrams per .gz
+    file for lang and n."""
+
+    files = [f for f in os.listdir(per_gz_file_path(lang))
+             if re.match(rf"^ngrams_{n}.*\.{per_gz_file_format}", f)]
+    files.sort()
+
+    return files
+
+def extra_settings_files(n):
+    return ["python/extra_settings/onechars_to_keep.csv",
+            "python/extra_settings/upcases_to_keep.csv",
+            f"python/extra_settings/extra_{n}grams_to_exclude.csv"]
+
+class TooMuchTruncatedError(Exception):
+    pass
 
-    global max_min_freq_per_file
+def check_if_too_much_truncated(lang, n, d, ctx):
     
     if d.shape[0] < number_of_most_freq[lang][n]:
 
-        raise Exception("Error: Not enough rows in outfile.",
-                        "\nNumber of rows in outfile:",
-                        d.shape[0], 
-                        "\nDesired number of rows:",
-                        number_of_most_freq[lang][n])
+        raise TooMuchTruncatedError("Error: Not enough rows in outfile.",
+                                    "\nNumber of rows in outfile:",
+                                    d.shape[0], 
+                                    "\nDesired number of rows:",
+                                    number_of_most_freq[lang][n])
 
-    elif (d['freq'].iloc[number_of_most_freq[lang][n] - 1] <=
-          max_min_freq_per_file):
+    lowest_freq = d['freq'].iloc[number_of_most_freq[lang][n] - 1]
 
-        raise Exception("Error: Too few rows read per file.",
-                        "\nLowest frequency in outfile:", 
-                        d['freq'].iloc[number_of_most_freq[lang][n] - 1],
-                        "\nHighest frequency truncated at:",
-                        max_min_freq_per_file)
+    if lowest_freq <= ctx["max_min_freq_per_file"]:
+
+        raise TooMuchTruncatedError("Error: Too few rows read per file.",
+                                    "\nLowest frequency in outfile:", 
+                                    lowest_freq,
+                                    "\nHighest frequency truncated at:",
+                                    ctx["max_min_freq_per_file"])
 
 
 ###############################################################################
 # Functions
 
-def gather_per_gz_files(lang, n):
+def end_of_rows(ngrams, nrows, start=0):
+    """Returns the position just after the nrows-th newline in the bytes
+    'ngrams' after position start, scanning only as far as needed."""
 
-    global max_min_freq_per_file
+    end = start
+    while nrows > 0:
+        chunk = ngrams[end:end + max(32 * nrows, 2**16)]
+        newlines = np.flatnonzero(chunk == 10)
+        if len(newlines) >= nrows:
+            return end + newlines[nrows - 1] + 1
+        nrows -= len(newlines)
+        end += len(chunk)
 
-    files = [f for f in os.listdir(per_gz_file_path(lang))
-             if re.match(rf"^ngrams_{n}.*\.csv", f)]
-    files.sort()
+    return end
 
-    d = list()
-    for file in files:
-        d += [pd.read_csv(per_gz_file_path(lang) + '/' + file,
-                          nrows=per_file_number_of_most_freq[lang][n])]
-        max_min_freq_per_file = max(d[-1]['freq'].iloc[-1],
-                                    max_min_freq_per_file)
 
-    d = pd.concat(d)
-    d = d.sort_values(by=['freq'], ascending=False)
-    d = d[~d.ngram.isnull()]  # remove empty ngrams
-    d = d.reset_index(drop=True)
+def read_per_gz_file_bin_chunk(path, nrows=None, position=(0, 0)):
+    """Reads nrows rows of a list of most frequent ngrams in the binary
+    format written by download_and_extract_most_freq.py from 'position'
+    on: the number of rows before them and the offset at which their
+    ngrams start. Returns the rows and the position after them. The file
+    is memory-mapped, so only the rows read are loaded from disk."""
+
+    m = np.memmap(path, dtype=np.uint8, mode='r')
+
+    if bytes(m[:8]) != per_gz_file_magic:
+        raise Exception("Error: Not a list of most frequent ngrams:", path)
+
+    count, itemsize = m[8:24].view('<i8')
+    freqs_end = 24 + count * itemsize
+    freqs = m[24:freqs_end].view('<u4' if itemsize == 4 else '<i8')
+    ngrams = m[freqs_end:]
+
+    row, start = position
+    row = min(row, count)
+    if nrows is None or nrows > count - row:
+        nrows = count - row
+
+    end = end_of_rows(ngrams, nrows, start)
+
+    ngrams = bytes(ngrams[start:end]).decode('utf-8').split("\n")[:nrows]
+    d = pd.DataFrame({'ngram': [np.nan if s in default_na_strings else s
+                                for s in ngrams],
+                      'freq': freqs[row:row + nrows].astype(np.int64)})
+
+    return d, (row + nrows, end)
 
-    check_if_too_much_truncated(lang, n, d)
+
+def read_per_gz_file_bin(path, nrows=None):
+    """Reads the first nrows rows of a list of most frequent ngrams in the
+    binary format written by download_and_extract_most_freq.py."""
+
+    return read_per_gz_file_bin_chunk(path, nrows)[0]
+
+
+def read_per_gz_file_csv_chunk(path, nrows=None, position=(0, 0)):
+    """Reads nrows rows of a list of most frequent ngrams in csv format
+    from 'position' on: the number of rows before them and the offset at
+    which they start in the file (0 for the first row, after the header).
+    Returns the rows and the position after them. Each row is one line,
+    so the rows before are skipped without parsing them."""
+
+    row, start = position
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        if start == 0:
+            f.readline()
+        lines = list(itertools.islice(f, nrows))
+        end = f.tell()
+
+    if not lines:
+        return pd.DataFrame({'ngram': pd.Series(dtype=object),
+                             'freq': pd.Series(dtype=np.int64)}), (row, end)
+
+    # ngrams as strings, as chunks of only numbers would be read as such
+    d = pd.read_csv(io.BytesIO(b"".join(lines)), header=None,
+                    names=['ngram', 'freq'], dtype={'ngram': str})
+
+    return d, (row + len(lines), end)
+
+
+def read_per_gz_file_chunk(path, nrows=None, position=(0, 0)):
+    """Reads nrows rows of a list of most frequent ngrams of one .gz file
+    from 'position' on, which is (0, 0) for the first row. Returns the
+    rows and the position after them."""
+
+    if path.endswith(".bin"):
+        return read_per_gz_file_bin_chunk(path, nrows, position)
+    else:
+        return read_per_gz_file_csv_chunk(path, nrows, position)
+
+
+class PerGzFileMerger:
+    """K-way merge of the first nrows rows (all if None) of the lists of
+    most frequent ngrams per .gz file at 'paths', with one cursor per
+    file, into one list sorted by decreasing frequency, equally frequent
+    ngrams ordered by file and row, as sorting all rows by frequency with
+    a stable sort would.
+    The rows are merged in bands of decreasing frequency: for a threshold
+    freq, each file is read on in chunks, growing from gather_chunk_rows to
+    gather_max_chunk_rows rows, until its last row read is less frequent,
+    and then the rows read at least as frequent are sorted and appended to
+    the merged rows, which are thus sorted only once. The threshold then
+    halves. So each file is only read as deep as the rows merged so far
+    reach, and the rows read but not merged yet are at most one chunk per
+    file. 'merge' can be called again with more rows to merge, continuing
+    where the last call stopped."""
+
+    def __init__(self, paths, nrows):
+        self.paths = paths
+        self.nrows = nrows
+        nfiles = len(paths)
+        self.positions = [(0, 0)] * nfiles
+        self.chunk_rows = [gather_chunk_rows] * nfiles
+        self.rows_read = np.zeros(nfiles, dtype=np.int64)
+        # frequency of the last row read of each file, -1 if none
+        self.last_freq = np.full(nfiles, -1, dtype=np.int64)
+        self.exhausted = np.zeros(nfiles, dtype=bool)
+        # rows read but not merged yet, and the bands of rows merged: their
+        # ngram, frequency, file and row in the file
+        self.unmerged = self.empty_rows()
+        self.merged = [self.empty_rows()]
+        self.nonempty = 0   # number of non-empty ngrams merged
+        self.threshold = None
+
+    @staticmethod
+    def empty_rows():
+        return [np.zeros(0, dtype=object)] + [np.zeros(0, dtype=np.int64)] * 3
+
+    def read_until(self, i, threshold):
+        """Reads file i on until its last row read is less frequent than
+        threshold, or it is exhausted. Returns the rows read."""
+
+        chunks = list()
+
+        while not self.exhausted[i] and (self.rows_read[i] == 0
+                                         or self.last_freq[i] >= threshold):
+            # None for the rest of the file
+            rows = self.chunk_rows[i]
+            if self.nrows is not None:
+                rows = min(rows or self.nrows, self.nrows - self.rows_read[i])
+            d, self.positions[i] = read_per_gz_file_chunk(
+                self.paths[i], rows, self.positions[i])
+            if self.chunk_rows[i] is not None:
+                self.chunk_rows[i] = min(2 * self.chunk_rows[i],
+                                         gather_max_chunk_rows)
+            chunks += [[d['ngram'].to_numpy(dtype=object),
+                        d['freq'].to_numpy(dtype=np.int64),
+                        np.full(d.shape[0], i),
+                        self.rows_read[i] + np.arange(d.shape[0])]]
+            self.rows_read[i] += d.shape[0]
+            if d.shape[0] > 0:
+                self.last_freq[i] = d['freq'].iat[-1]
+            if (rows is None or d.shape[0] < rows
+                or self.rows_read[i] == self.nrows):
+                self.exhausted[i] = True
+
+        return chunks
+
+    def merge_band(self, last=False):
+        """Merges the rows at least as frequent as the next threshold, or
+        all rows left if last."""
+
+        if self.threshold is None:
+            # read the first chunk of each file to find the highest
+            # frequency
+            chunks = [chunk for i in range(len(self.paths))
+                      for chunk in self.read_until(i, np.inf)]
+            self.unmerged = [np.concatenate(column) for column
+                             in zip(self.unmerged, *chunks)]
+
+        # the rows not merged yet are at most as frequent as this
+        highest = max(self.unmerged[1].max(initial=-1),
+                      self.last_freq[~self.exhausted].max(initial=-1))
+        self.threshold = (highest if self.threshold is None
+                          else min(self.threshold // 2, highest))
+        if last:
+            self.threshold = -1
+
+        chunks = [chunk for i in np.flatnonzero(~self.exhausted
+                                                & (self.last_freq
+                                                   >= self.threshold))
+                  for chunk in self.read_until(i, self.threshold)]
+        rows = [np.concatenate(column) for column
+                in zip(self.unmerged, *chunks)]
+
+        if last:
+            self.unmerged = self.empty_rows()
+        else:
+            band = rows[1] >= self.threshold
+            self.unmerged = [column[~band] for column in rows]
+            rows = [column[band] for column in rows]
+
+        order = np.lexsort((rows[3], rows[2], -rows[1]))
+        self.merged += [[column[order] for column in rows]]
+        self.nonempty += int(np.count_nonzero(~pd.isna(self.merged[-1][0])))
+
+    def merge(self, max_rows, ctx):
+        """Returns the max_rows (all if None) most frequent non-empty ngrams
+        and how many rows of each file were merged, and updates ctx as
+        'gather_per_gz_files' does."""
+
+        # all rows are merged, so there is no point in reading the files
+        # in chunks or merging them in bands
+        if max_rows is None:
+            self.chunk_rows = [None] * len(self.paths)
+
+        # merge beyond the max_rows-th non-empty ngram, so that the row
+        # after it, the most frequent one not merged, is known
+        while ((self.unmerged[0].size > 0 or not self.exhausted.all())
+               and (max_rows is None or self.nonempty <= max_rows)):
+            self.merge_band(last=max_rows is None)
+
+        merged = [np.concatenate(column) for column in zip(*self.merged)]
+        self.merged = [merged]
+
+        # the merge ends after the max_rows-th non-empty ngram
+        end = len(merged[0])
+        if max_rows is not None and self.nonempty >= max_rows:
+            end = int(np.searchsorted(np.cumsum(~pd.isna(merged[0])),
+                                      max_rows)) + 1
+
+        ctx["gather_stopped_early"] = end < len(merged[0])
+        if end < len(merged[0]):
+            # ngrams not merged are at most as frequent as this one
+            ctx["max_min_freq_per_file"] = max(int(merged[1][end]),
+                                               ctx["max_min_freq_per_file"])
+
+        depths = np.bincount(merged[2][:end], minlength=len(self.paths))
+
+        # files whose rows read have all been merged
+        done = self.exhausted & (depths == self.rows_read)
+        if done.any():
+            ctx["max_min_freq_per_file"] = max(
+                int(self.last_freq[done].max()), ctx["max_min_freq_per_file"])
+
+        nonempty = ~pd.isna(merged[0][:end])
+        d = pd.DataFrame({'ngram': merged[0][:end][nonempty],
+                          'freq': merged[1][:end][nonempty]})
+
+        return d, depths
+
+
+def gather_per_gz_files(lang, n, ctx, rows_factor=None):
+    """Merges the lists of most frequent ngrams of all .gz files, which are
+    each sorted by frequency, into one sorted list, stopping after
+    rows_factor times the final number of ngrams if set (see
+    'PerGzFileMerger'). Prints how many rows of each file were
+    merged."""
+
+    files = per_gz_files(lang, n)
+    paths = [per_gz_file_path(lang) + '/' + file for file in files]
+
+    if adaptive_gather:
+        nrows = None
+    else:
+        nrows = per_file_number_of_most_freq[lang][n]
+
+    max_rows = None
+    if rows_factor is not None:
+        max_rows = rows_factor * number_of_most_freq[lang][n]
+
+    # with adaptive_gather the merger is kept in ctx, so that
+    # 'gather_and_clean_adaptive' merges on from where the last try stopped
+    # instead of reading all files again
+    merger = ctx.get("merger") or PerGzFileMerger(paths, nrows)
+    if adaptive_gather:
+        ctx["merger"] = merger
+    d, depths = merger.merge(max_rows, ctx)
+
+    if files:
+        rows_read = merger.rows_read
+        print(f"{lang}, n={n}: merged {sum(depths)} rows of {len(files)} "
+              f"files, rows per file: min {min(depths)}, "
+              f"median {int(np.median(depths))}, max {max(depths)}; "
+              f"read {rows_read.sum()} rows, per file: "
+              f"max {rows_read.max()}")
+
+    check_if_too_much_truncated(lang, n, d, ctx)
     (d[:number_of_most_freq[lang][n]]
      .to_csv(f"ngrams/more/{lang}/{n}grams_{lang}_0_raw.csv",
              index=False))
@@ -179,35 +554,37 @@ def gather_per_gz_files(lang, n):
     return d
 
 
-def clean_remove_pos_tags(lang, n, d):
+def clean_remove_pos_tags(lang, n, d, ctx):
 
     pos_tags = "(?:VERB|NOUN|NUM|DET|ADV|ADJ|ADP|CONJ|PRON|PRT|X|\.|END|START)"
 
     # remove ngrams amongst whose words are free/wildcard part-of-speech tags
-    d = d[~d.ngram.str.contains(rf'(?:^| )_{pos_tags}_(?: |$)')]
+    rules = [("pos_wildcard", rf'(?:^| )_{pos_tags}_(?: |$)', [])]
 
     if n > 1:
         # remove ngrams starting or ending with a punctuation "word"
         # such ngrams will appear in lower ngrams without the punctuation
-        d = d[~d.ngram.str.contains(r' [\W_]+$')]
-        d = d[~d.ngram.str.contains(r'^[\W_]+ ')]
+        rules += [("punctuation_end", r' [\W_]+$', []),
+                  ("punctuation_start", r'^[\W_]+ ', [])]
 
         # this also captures misclassified punctuation
-        d = d[~d.ngram.str.contains(rf' [\W_]+_{pos_tags}$')]
-        d = d[~d.ngram.str.contains(rf'^[\W_]+_{pos_tags} ')]
+        rules += [("punctuation_end", rf' [\W_]+_{pos_tags}$', []),
+                  ("punctuation_start", rf'^[\W_]+_{pos_tags} ', [])]
 
     # for 1grams save a version that removes ngrams with no pos tags
-    contains_pos = d.ngram.str.contains(rf'_{pos_tags}(?: |$)')
+    rules += [("contains_pos", rf'_{pos_tags}(?: |$)', [])]
+    reasons = classify_ngrams(d.ngram, compile_rules(rules))
+    contains_pos = reasons == len(rules)
     if n == 1:
-        check_if_too_much_truncated(lang, n, d[contains_pos])
+        check_if_too_much_truncated(lang, n, d[contains_pos], ctx)
         (d[contains_pos].head(number_of_most_freq[lang][n])
          .to_csv(f"ngrams/more/{lang}/{n}grams_{lang}_1b_with_pos.csv",
                  index=False))
 
     # remove ngrams with any pos tags
-    d = d[~contains_pos]
+    d = d[reasons == 0]
     d = d.reset_index(drop=True)
-    check_if_too_much_truncated(lang, n, d)
+    check_if_too_much_truncated(lang, n, d, ctx)
     (d[:number_of_most_freq[lang][n]].
      to_csv(f"ngrams/more/{lang}/{n}grams_{lang}_1a_no_pos.csv",
             index=False))
@@ -215,11 +592,199 @@ def clean_remove_pos_tags(lang, n, d):
     return d
 
 
+def fingerprint(*parts):
+    """Returns a hash of 'parts', which are dumped as JSON."""
+
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str)
+                          .encode('utf-8')).hexdigest()
+
+
+def file_hash(path):
+    """Returns a hash of the contents of the file at path, or None if it
+    does not exist."""
+
+    if not os.path.exists(path):
+        return None
+
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def gather_stage_fingerprint(lang, n, rows_factor, without_pos=True):
+    """Returns a fingerprint of everything 'gather_per_gz_files', and
+    'clean_remove_pos_tags' if without_pos, depend on: the name, size and
+    modification time of each list of most frequent ngrams per .gz file,
+    the settings deciding how far they are read (the truncation settings)
+    and others used, and the code of the functions involved."""
+
+    shards = [(f, os.stat(per_gz_file_path(lang) + '/' + f).st_size,
+               os.stat(per_gz_file_path(lang) + '/' + f).st_mtime_ns)
+              for f in per_gz_files(lang, n)]
+
+    functions = [end_of_rows, read_per_gz_file_bin_chunk,
+                 read_per_gz_file_bin, read_per_gz_file_csv_chunk,
+                 read_per_gz_file_chunk, PerGzFileMerger,
+                 gather_per_gz_files, check_if_too_much_truncated]
+    if without_pos:
+        functions += [clean_remove_pos_tags]
+
+    return fingerprint("gather_stage", lang, n, shards, year_start, year_end,
+                       per_gz_file_window, per_gz_file_format,
+                       adaptive_gather, per_file_number_of_most_freq[lang][n],
+                       number_of_most_freq[lang][n], rows_factor,
+                       without_pos, sorted(default_na_strings),
+                       [inspect.getsource(f) for f in functions])
+
+
+def write_gathered_bin(d, path):
+    """Writes d in the binary format of the lists of most frequent ngrams
+    per .gz file, which 'read_per_gz_file_bin' reads; should be the same
+    as write_per_gz_file_bin in download_and_extract_most_freq.py."""
+
+    freqs = d['freq'].to_numpy()
+    if freqs.size == 0 or freqs.max() < 2**32:
+        freqs = freqs.astype('<u4')
+    else:
+        freqs = freqs.astype('<i8')
+
+    with open(path, 'wb') as f:
+        f.write(per_gz_file_magic)
+        f.write(np.array([freqs.size, freqs.itemsize], dtype='<i8')
+                .tobytes())
+        f.write(freqs.tobytes())
+        f.write("".join(ngram + "\n" for ngram in d['ngram'])
+                .encode('utf-8'))
+
+
+def cached_gather_stage(lang, n, ctx, rows_factor, without_pos, stage):
+    """Returns stage(), the merged lists of most frequent ngrams per .gz
+    file, without POS tags if without_pos, reusing the result cached
+    under its fingerprint (see 'gather_stage_fingerprint') if there is
+    one. The result is cached in the binary format of the lists per .gz
+    file, with copies of the csv-files the stage writes to
+    ngrams/more/{lang}, which are written again when the result is
+    reused, and the state the stage leaves in ctx, including whether too
+    much was truncated, next to it as JSON, which is written last. If too
+    much was truncated, the csv-files are not written, as the stage stops
+    before. Cached results of the same stage for other lists per .gz file
+    or settings are deleted when a new one is saved."""
+
+    stage_name = '1a_no_pos' if without_pos else '0_raw'
+    prefix = f"{cache_path(lang)}/{n}grams_{lang}_{stage_name}_"
+    # the rows_factor is kept apart in the name, so that the results of
+    # the rows_factors tried by 'gather_and_clean_adaptive' are all kept
+    inputs_fingerprint = gather_stage_fingerprint(lang, n, None,
+                                                  without_pos)[:16]
+    path = prefix + f"{inputs_fingerprint}_{rows_factor}"
+    ctx_keys = ["max_min_freq_per_file", "gather_stopped_early"]
+
+    outputs = ["0_raw"]
+    if without_pos:
+        outputs += ["1b_with_pos"] if n == 1 else []
+        outputs += ["1a_no_pos"]
+    outputs = {f"{path}_{output}.csv":
+               f"ngrams/more/{lang}/{n}grams_{lang}_{output}.csv"
+               for output in outputs}
+
+    if os.path.exists(path + ".json"):
+        with open(path + ".json") as f:
+            cached_ctx = json.load(f)
+        truncated = cached_ctx.pop("too_much_truncated")
+        # files deleted from the cache are made again
+        if truncated or all(os.path.exists(file) for file
+                            in [path + ".bin"] + list(outputs)):
+            ctx.update(cached_ctx)
+            print(f"{lang}, n={n}: reusing gathered ngrams"
+                  + (" without POS tags" if without_pos else ""))
+            if truncated:
+                raise TooMuchTruncatedError(
+                    "Error: Too much truncated (cached).")
+            for cached_output, output in outputs.items():
+                shutil.copyfile(cached_output, output)
+            return read_per_gz_file_bin(path + ".bin")
+
+    def save(d):
+        if d is not None:
+            write_gathered_bin(d, path + ".bin.tmp")
+            os.replace(path + ".bin.tmp", path + ".bin")
+            for cached_output, output in outputs.items():
+                shutil.copyfile(output, cached_output)
+        cached_ctx = {key: ctx[key] for key in ctx_keys if key in ctx}
+        cached_ctx["too_much_truncated"] = d is None
+        with open(path + ".json.tmp", 'w') as f:
+            json.dump(cached_ctx, f)
+        os.replace(path + ".json.tmp", path + ".json")
+
+        # delete what was cached for other inputs
+        for file in os.listdir(cache_path(lang)):
+            file = cache_path(lang) + '/' + file
+            if (file.startswith(prefix)
+                and not file.startswith(prefix + inputs_fingerprint)):
+                os.remove(file)
+
+    try:
+        d = stage()
+    except TooMuchTruncatedError:
+        save(None)
+        raise
+
+    save(d)
+
+    return d
+
+
+def gather_and_remove_pos_tags(lang, n, ctx, rows_factor=None):
+    """Runs gather_per_gz_files and clean_remove_pos_tags. If cache_gathered
+    or incremental_rebuild, the result of both, or only of the first if not
+    cache_gathered_without_pos, is cached (see 'cached_gather_stage')."""
+
+    def gather():
+        return gather_per_gz_files(lang, n, ctx, rows_factor)
+
+    def gather_and_clean_pos():
+        return clean_remove_pos_tags(lang, n, gather(), ctx)
+
+    if not (cache_gathered or incremental_rebuild):
+        return gather_and_clean_pos()
+
+    if cache_gathered_without_pos:
+        return cached_gather_stage(lang, n, ctx, rows_factor, True,
+                                   gather_and_clean_pos)
+
+    d = cached_gather_stage(lang, n, ctx, rows_factor, False, gather)
+    return clean_remove_pos_tags(lang, n, d, ctx)
+
+
 def split_contractions(d, dother):
     '''Split contractions in the ngram column of 'd' append the resulting 
     larger n-grams to the corresponding dataframe in 'dother'.
     Examples of contractions are qu'il and c'est.
-    Return a touple of the modified 'd' and 'dother'.'''
+    Return a touple of the modified 'd' and 'dother'.
+    Each word is split after every "'", and the ngram rejoined with
+    single spaces, using vectorized string operations.'''
+
+    n = d.ngram.str.count(" ").max() + 1
+
+    ngrams = (d.ngram.str.replace("'", "' ", regex=False)
+              .str.replace(" +", " ", regex=True)
+              .str.strip(" "))
+    nwords = (ngrams.str.count(" ") + 1).where(ngrams != "", 0)
+
+    d = d.assign(ngram=ngrams.str.strip())
+
+    # add the ngrams which now have other than n words to dother
+    for i in set(np.unique(nwords).tolist()) - {n}:
+        dother[i] = pd.concat([dother[i], d[nwords == i]])
+
+    d = d[nwords == n]
+
+    return d, dother
+
+
+def split_contractions_with_apply(d, dother):
+    '''The original implementation of split_contractions, splitting
+    into columns and joining row by row; kept for comparison in
+    benchmarks.py.'''
     
     dt = d.ngram.str.split(" ", expand=True)
     n = dt.shape[1]
@@ -255,16 +820,8 @@ def split_contractions(d, dother):
 
 def split_2grams_to_1grams(d2):
 
-    dt = d2.ngram.str.split(" ", expand=True)
-    n = dt.shape[1]
-
-    dt = dt.stack(dropna=False)
-    dt = dt.reset_index(level=[0,1], drop=True)
-
-    df = pd.DataFrame(np.repeat(d2.freq.values, n, axis=0))
-
-    dt = pd.concat([dt, df], axis=1)
-    dt.columns = ["ngram", "freq"]
+    dt = d2.assign(ngram=d2.ngram.str.split(" ")).explode("ngram")
+    dt = dt[["ngram", "freq"]].reset_index(drop=True)
 
     return dt
 
@@ -273,9 +830,44 @@ def merge_upcase_lowcase(d, cutoff):
     '''Combine words with different capitalization. 
     E.g. il - Il, le - Le, je - Je, etc.
     Merges capitalized entries to non-capitalized ones unless 
-    the share capitalized is at least cutoff.
+    the share capitalized is at least cutoff, in which case the
+    non-capitalized entry is removed.
     cutoff = 0.92 is a good value for French.
-    For German this works too.'''
+    For German this works too.
+    Looks up the non-capitalized version of each capitalized entry in
+    a hash index of the ngrams, which have to be unique, instead of
+    merging dataframes as merge_upcase_lowcase_with_merges does.'''
+
+    ngrams = d['ngram'].to_numpy()
+    freq = d['freq'].to_numpy()
+
+    up = np.flatnonzero([s[:1].isupper() for s in ngrams])
+    low = pd.Index(ngrams).get_indexer([s[:1].lower() + s[1:]
+                                        for s in ngrams[up]])
+    # merging it like this ignores words that are all cap,
+    # since they'd cause problems later and are few enough to ignore
+
+    up = up[low >= 0]
+    low = low[low >= 0]
+    shareup = freq[up] / (freq[up] + freq[low])
+
+    keep = np.ones(len(ngrams), dtype=bool)
+    keep[up[shareup < cutoff]] = False
+    keep[low[shareup >= cutoff]] = False
+
+    freq = freq.copy()
+    freq[low] += freq[up]
+
+    d = pd.DataFrame({'ngram': ngrams[keep],
+                      'freq': freq[keep].astype('int')})
+    d = d.sort_values(by=['freq'], ascending=False).reset_index(drop=True)
+
+    return d
+
+
+def merge_upcase_lowcase_with_merges(d, cutoff):
+    '''The original implementation of merge_upcase_lowcase, merging
+    dataframes; kept for comparison in benchmarks.py.'''
 
     first_letter = d['ngram'].str[:1]
     later_letters = d['ngram'].str[1:]
@@ -343,18 +935,110 @@ def merge_upcase_lowcase(d, cutoff):
 
 
 
-def remove_pattern(d, pattern, exceptions=[]):
-    '''Look for regex 'pattern' and remove matching ngrams,
-    except if they are in list 'exceptions'.'''
-    global freq_words_removed
-    if exceptions != []:
-        freq_words_removed += d[(d.ngram.str.contains(pattern)) &
-                                (~d['ngram'].isin(exceptions))].freq.sum()
-        d = d[(~d.ngram.str.contains(pattern)) | (d['ngram'].isin(exceptions))]
+def removal_rules(lang, n):
+    '''Return the rules for removing ngrams of lang and n while cleaning,
+    in the order they are applied: each is a reason, a regex or list of
+    ngrams, and a list of exceptions.'''
+
+    rules = list()
+
+
+    # remove entries with only punctuation and numbers
+    punctuation_and_numbers_regex = r"^[ _\W0-9]+$"
+    rules += [("punctuation_and_numbers", punctuation_and_numbers_regex, [])]
+
+
+    # handle uppercase words
+    if n == 1:
+        if lang == 'german':
+            upcase_regex = r"^[A-ZÀ-Ü]+$"
+        else:
+            upcase_regex = r"[A-ZÀ-ÜА-Я]"
+        rules += [("upcase", upcase_regex, upcases_to_keep[lang])]
+
+
+    # remove most one-character words    
+    if n == 1 and lang != 'chinese_simplified':     
+        onechar_regex = r"^.$"
+        rules += [("onechar", onechar_regex, onechars_to_keep[lang])]
+
+
+    # remove contractions for some langagues
+    # TODO remove for other languages too?
+    if lang in ['german', 'russian']:
+        rules += [("contraction", r"'", [])]
+
+    if lang in ['english-fiction']:
+        rules += [("contraction", r"^'", [])]
+
+
+    # remove entries with non-word characters other than ",", " ", and ","
+    # TODO this needs to be changed, especially for n-grams with n > 1
+    if lang == 'russian':
+        nonword_regex = r"[^\w', -]"
+    elif lang == 'hebrew':
+        nonword_regex = r"[^\w' \",]"
     else:
-        freq_words_removed += d[d.ngram.str.contains(pattern)].freq.sum()
-        d = d[~d.ngram.str.contains(pattern)]
-    return d
+        nonword_regex = r"[^\w' ,]"
+    rules += [("nonword", nonword_regex, [])]
+
+
+    # remove entries with numbers
+    rules += [("number", r"[0-9]", [])]
+
+
+    # remove entries in wrong alphabet
+    if lang in ['chinese_simplified', 'hebrew', 'russian']:
+        rules += [("wrong_alphabet", r"[a-zA-Z]", [])]
+
+
+    # remove empty entries
+    rules += [("empty", r"^[ \t\n]*$", [])]
+        
+    # manually remove any remaining unwanted ngrams
+    # e.g. names of persons, wrong language words,
+    #      some abbrevations without a dot, copyright notices    
+    rules += [("excluded", extra_ngrams_to_exclude[n][lang], [])]
+
+    return rules
+
+
+def compile_rules(rules):
+    '''Compile a list of (reason, regex or list of ngrams, exceptions)
+    rules for removing ngrams, for use with classify_ngrams.'''
+    compiled = []
+    for reason, rule, exceptions in rules:
+        if isinstance(rule, str):
+            rule = re.compile(rule)
+        else:
+            rule = set(rule)
+        compiled += [(reason, rule, set(exceptions))]
+    return compiled
+
+
+def classify_ngrams(ngrams, rules):
+    '''Return an array giving for each of 'ngrams' the number, counting
+    from 1, of the first of the compiled 'rules' which removes it, or 0 if
+    none does. A rule removes an ngram if its regex matches, or its list
+    contains, the ngram, unless the ngram is one of the rule's exceptions.
+    Each rule is checked with one str.contains or isin over the ngrams no
+    earlier rule removes: about as fast as checking all rules per ngram,
+    and twice as fast as one regex alternating between them (see
+    benchmark_classify_ngrams in benchmarks.py).'''
+    reasons = np.zeros(len(ngrams), dtype=np.int8)
+
+    for i, (reason, rule, exceptions) in enumerate(rules, start=1):
+        left = np.flatnonzero(reasons == 0)
+        ngrams_left = ngrams.iloc[left]
+        if isinstance(rule, set):
+            removes = ngrams_left.isin(rule)
+        else:
+            removes = ngrams_left.str.contains(rule)
+        if exceptions:
+            removes &= ~ngrams_left.isin(exceptions)
+        reasons[left[removes.to_numpy()]] = i
+
+    return reasons
 
 
 def replace_pattern_and_group(d, pattern, replacement):
@@ -368,14 +1052,6 @@ def replace_pattern_and_group(d, pattern, replacement):
     return d
 
 
-def remove_entries(d, entries):
-    '''Remove 'entries', updating 'freq_words_removed'.'''
-    global freq_words_removed
-    freq_words_removed += d[d['ngram'].isin(entries)].freq.sum()
-    d = d[~d['ngram'].isin(entries)]
-    return d
-
-
 def get_total_number_of_1grams(lang, year_start=None, year_end=None,
                                freq_words_added=0, freq_words_removed=0):
     f = open(totalcounts_1_file(lang))
@@ -397,47 +1073,52 @@ def get_total_number_of_1grams(lang, year_start=None, year_end=None,
     return total_in_period
 
 
-def gather_and_clean(lang, n):
-    
-    global max_min_freq_per_file
-    max_min_freq_per_file = 0
-
-    global freq_words_added
-    freq_words_added = 0
+def gather_and_clean(lang, n, rows_factor=None, ctx=None, drouted=None):
+    '''Gather and clean the ngrams for one lang and n. The state of the
+    job is kept in the dict ctx, so that jobs can run in parallel.
+    The ngrams in 'drouted', which got n words when splitting contractions
+    at a lower n, are added before cleaning. rows_factor defaults to
+    gather_rows_factor. Return the dictionary of ngrams which got another
+    number of words here, by number of words.'''
 
-    global freq_words_removed
-    freq_words_removed = 0
+    if rows_factor is None:
+        rows_factor = gather_rows_factor
+    if ctx is None:
+        ctx = dict()
+    ctx["max_min_freq_per_file"] = 0
+    ctx["freq_words_added"] = 0
+    ctx["freq_words_removed"] = 0
 
     # dictionary of dataframes to hold ngrams to be added at other n
     df_empty = pd.DataFrame({'ngram' : [], 'freq' : []})
     dother = {key: df_empty for key in range(1, 11)}
 
     
-    # gather ngrams
-    d = gather_per_gz_files(lang, n)
-
-    
-    # remove part-of-speech tags
-    d = clean_remove_pos_tags(lang, n, d)
+    # gather ngrams and remove part-of-speech tags
+    d = gather_and_remove_pos_tags(lang, n, ctx, rows_factor)
 
 
     # split contractions
 
-    if lang in ['french', 'italian']:
+    if lang in langs_with_contractions:
 
         d, dother = split_contractions(d, dother)
 
         ## add the parts of the 2-grams resulting from split back as 1-grams
 
         if n == 1:
-            freq_words_added += sum(dother[2].freq)
+            ctx["freq_words_added"] += sum(dother[2].freq)
             dadd = split_2grams_to_1grams(dother[2])
             d = pd.concat([d, dadd], axis=0)
             d = d.groupby("ngram")[["freq"]].sum()
             d.reset_index(level=0, inplace=True)
             d = (d.sort_values(by=['freq'], ascending=False)
                  .reset_index(drop=True))
-            dother[2] = df_empty
+
+
+    # add ngrams routed here from lower n, to be grouped with the others
+    if drouted is not None:
+        d = pd.concat([d, drouted], axis=0)
 
 
     # handle entries ending with "_"
@@ -448,70 +1129,22 @@ def gather_and_clean(lang, n):
     d = merge_upcase_lowcase(d, 0.92)
 
 
-    # save copy of data before starting to remove entries
-    dfull = d
-
-
-    # remove entries with only punctuation and numbers
-    punctuation_and_numbers_regex = r"^[ _\W0-9]+$"
-    d = remove_pattern(d, punctuation_and_numbers_regex)
-
-
-    # handle uppercase words
-    if n == 1:
-        if lang == 'german':
-            upcase_regex = r"^[A-ZÀ-Ü]+$"
-        else:
-            upcase_regex = r"[A-ZÀ-ÜА-Я]"
-        d = remove_pattern(d, upcase_regex, upcases_to_keep[lang])
-
-
-    # remove most one-character words    
-    if n == 1 and lang != 'chinese_simplified':     
-        onechar_regex = r"^.$"
-        d = remove_pattern(d, onechar_regex, onechars_to_keep[lang])
-
-
-    # remove contractions for some langagues
-    # TODO remove for other languages too?
-    if lang in ['german', 'russian']:
-        d = remove_pattern(d, r"'")
-
-    if lang in ['english-fiction']:
-        d = remove_pattern(d, r"^'")    
-
+    # collect the rules for removing entries, in the order they are applied
+    rules = removal_rules(lang, n)
 
-    # remove entries with non-word characters other than ",", " ", and ","
-    # TODO this needs to be changed, especially for n-grams with n > 1
-    if lang == 'russian':
-        nonword_regex = r"[^\w', -]"
-    elif lang == 'hebrew':
-        nonword_regex = r"[^\w' \",]"
-    else:
-        nonword_regex = r"[^\w' ,]"
-    d = remove_pattern(d, nonword_regex)
-
-
-    # remove entries with numbers
-    d = remove_pattern(d, r"[0-9]")
 
-
-    # remove entries in wrong alphabet
-    if lang in ['chinese_simplified', 'hebrew', 'russian']:
-        d = remove_pattern(d, r"[a-zA-Z]")
+    # apply all rules at once
+    reasons = classify_ngrams(d.ngram, compile_rules(rules))
+    ctx["freq_words_removed"] += d.freq[reasons > 0].sum()
+    drem = d[reasons > 0]
+    d = d[reasons == 0]
 
 
-    # remove empty entries
-    d = remove_pattern(d, r"^[ \t\n]*$")
-        
-    # manually remove any remaining unwanted ngrams
-    # e.g. names of persons, wrong language words,
-    #      some abbrevations without a dot, copyright notices    
-    d = remove_entries(d, extra_ngrams_to_exclude[n][lang])
+    # check that enough ngrams are left, before relying on it below
+    check_if_too_much_truncated(lang, n, d, ctx)
 
 
     # save dataframe of removed words
-    drem = dfull[~dfull.ngram.isin(d.ngram)]
     drem = (drem.sort_values(by=['freq'], ascending=False)
             .reset_index(drop=True))
     drem = drem[drem.freq >= d.iloc[number_of_most_freq[lang][n]-1, 1]]
@@ -524,31 +1157,184 @@ def gather_and_clean(lang, n):
     if n == 1:
         d['share'] = (d['freq'] /
                       get_total_number_of_1grams(lang, year_start, year_end,
-                                                 freq_words_added,
-                                                 freq_words_removed))
+                                                 ctx["freq_words_added"],
+                                                 ctx["freq_words_removed"]))
         d['cumshare'] = d['share'].cumsum()
         del d['share']
         d = d[['ngram', 'freq', 'cumshare']]
         
     
     # save final output    
-    check_if_too_much_truncated(lang, n, d)
     (d[:number_of_most_freq[lang][n]]
      .to_csv(f"ngrams/{n}grams_{lang}.csv", index=False, float_format='%.3f'))
 
+    return dother
 
-def gather_and_clean_all():
 
-    for lang in langs:
+def gather_and_clean_adaptive(lang, n, drouted=None):
+    """Runs gather_and_clean, merging on to twice as many ngrams each time
+    too many of them turn out to be removed while cleaning. The merge
+    continues where it stopped (see 'gather_per_gz_files'), but the
+    cleaning is run again on all ngrams merged."""
+
+    rows_factor = gather_rows_factor or 2
+    ctx = dict()
+
+    while True:
+        try:
+            return gather_and_clean(lang, n, rows_factor, ctx, drouted)
+        except TooMuchTruncatedError:
+            if not ctx["gather_stopped_early"]:
+                raise
+            rows_factor *= 2
+            print(f"{lang}, n={n}: too much truncated, merging on to "
+                  f"rows_factor {rows_factor}")
+
+
+def gather_and_clean_one(lang, n, drouted=None):
+    """Runs gather_and_clean or gather_and_clean_adaptive, depending on
+    adaptive_gather."""
+
+    if adaptive_gather:
+        return gather_and_clean_adaptive(lang, n, drouted)
+    else:
+        return gather_and_clean(lang, n, drouted=drouted)
+
+
+def gather_and_clean_lang(lang):
+    """Gathers and cleans the ngrams for all ns of lang in one pipeline,
+    from the lowest n up, adding the ngrams which get more words when
+    splitting contractions to the table of the n they then have."""
 
-        print("language:", lang)
+    drouted = {n: list() for n in ns}
 
-        for n in ns:
+    for n in sorted(ns):
 
-            print("n:", n)
+        dother = gather_and_clean_one(
+            lang, n, pd.concat(drouted[n]) if drouted[n] else None)
 
-            gather_and_clean(lang, n)
-            
+        for m in dother:
+            if m > n and m in drouted and dother[m].shape[0] > 0:
+                drouted[m] += [dother[m]]
+
+
+def job_fingerprint(lang, n):
+    """Returns a fingerprint of everything the (lang, n) job depends on, all
+    ns of lang if n is None: the inputs of its gather stages (see
+    'gather_stage_fingerprint'), the extra settings files, the total counts
+    of 1grams, the settings, and this script."""
+
+    job_ns = sorted(ns) if n is None else [n]
+
+    if adaptive_gather:
+        rows_factor = gather_rows_factor or 2
+    else:
+        rows_factor = gather_rows_factor
+
+    return fingerprint("job", lang, n, job_ns,
+                       [gather_stage_fingerprint(lang, m, rows_factor)
+                        for m in job_ns],
+                       [file_hash(f) for m in job_ns
+                        for f in extra_settings_files(m)],
+                       file_hash(totalcounts_1_file(lang)),
+                       cross_n_pipeline, langs_with_contractions,
+                       file_hash(__file__))
+
+
+def job_fingerprint_path(lang, n):
+    return f"{cache_path(lang)}/{n or 'all'}grams_{lang}_job_fingerprint.txt"
+
+
+def job_is_unchanged(lang, n, job_fp):
+    """Returns whether the (lang, n) job was last run successfully with the
+    fingerprint job_fp and its final lists still exist."""
+
+    if any(not os.path.exists(f"ngrams/{m}grams_{lang}.csv")
+           for m in (ns if n is None else [n])):
+        return False
+
+    if not os.path.exists(job_fingerprint_path(lang, n)):
+        return False
+
+    with open(job_fingerprint_path(lang, n)) as f:
+        return f.read() == job_fp
+
+
+def gather_and_clean_job(job):
+    """Gathers and cleans the ngrams for one (lang, n) job, or all ns of
+    lang if n is None, and returns the job with the seconds it took and
+    the peak memory of its process in MB (None on Windows). If
+    incremental_rebuild, a job whose inputs are unchanged is skipped,
+    which is reported as None seconds."""
+
+    lang, n = job
+
+    if incremental_rebuild:
+        job_fp = job_fingerprint(lang, n)
+
+    start = timer()
+    if incremental_rebuild and job_is_unchanged(lang, n, job_fp):
+        end = None
+    elif n is None:
+        gather_and_clean_lang(lang)
+        end = timer()
+    else:
+        gather_and_clean_one(lang, n)
+        end = timer()
+
+    if incremental_rebuild and end is not None:
+        with open(job_fingerprint_path(lang, n) + ".tmp", 'w') as f:
+            f.write(job_fp)
+        os.replace(job_fingerprint_path(lang, n) + ".tmp",
+                   job_fingerprint_path(lang, n))
+
+    # kilobytes on Linux, bytes on macOS, not available on Windows
+    if resource is None:
+        peak = None
+    elif sys.platform == "darwin":
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e6
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+    return lang, n, None if end is None else end - start, peak
+
+
+def gather_and_clean_all():
+    """Gathers and cleans the ngrams for all langs and ns, running
+    number_of_cores jobs in parallel. Each job runs in a fresh process,
+    forked from this one, sharing the extra settings loaded above, where
+    fork is available and safe, and otherwise spawned, loading them
+    again."""
+
+    jobs = list()
+    for lang in langs:
+        if cross_n_pipeline and lang in langs_with_contractions:
+            jobs += [(lang, None)]
+        else:
+            jobs += [(lang, n) for n in ns]
+
+    if number_of_cores == 1:
+        reports = map(gather_and_clean_job, jobs)
+    else:
+        # fork is not available on Windows and not safe on macOS
+        if ("fork" in mp.get_all_start_methods()
+            and sys.platform != "darwin"):
+            context = mp.get_context("fork")
+        else:
+            context = mp.get_context("spawn")
+        pool = context.Pool(number_of_cores, maxtasksperchild=1)
+        reports = pool.imap_unordered(gather_and_clean_job, jobs)
+
+    for lang, n, seconds, peak in reports:
+        if seconds is None:
+            print(f"language: {lang}, n: {n or 'all'}, unchanged, skipped")
+            continue
+        print(f"language: {lang}, n: {n or 'all'}, {round(seconds, 1)}s"
+              + ("" if peak is None else f", peak memory {round(peak)} MB"))
+
+    if number_of_cores > 1:
+        pool.close()
+        pool.join()
 
 
 ###############################################################################
@@ -12,8 +12,14 @@
 # as around 483,000 characters.
 
 import pandas as pd
+import os, sqlite3, threading
 from pathlib import Path
-from google.cloud import translate_v2 as translate
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+try:
+    from google.cloud import translate_v2 as translate
+except ImportError:
+    translate = None
 
 
 ###############################################################################
@@ -48,6 +54,17 @@ do_cloud_translation = False
 # "python/extra_settings/manual_translations_1grams.csv",
 # applies some other fixes, and optionally add_equal_indicator
 
+# Where to cache the translations returned by Google, by source language,
+# target language, and text, so that they are not paid for again
+translation_cache_path = "ngrams/more/translation_cache.sqlite"
+
+# Maximum number of strings and of characters sent in one request
+translate_batch_size = 128
+translate_batch_chars = 5000
+
+# Number of requests sent at once
+translate_concurrency = 8
+
 
 ###############################################################################
 # Constants etc.
@@ -64,13 +81,33 @@ def ngramlist_path(n, lang):
 ###############################################################################
 # Functions
 
+# one client, reused by all calls and threads
+translate_client = None
+translate_client_lock = threading.Lock()
+
+def get_translate_client():
+    """Returns the Google Cloud Translate client, creating it once."""
+
+    global translate_client
+
+    if translate is None:
+        raise ImportError("google-cloud-translate is needed for "
+                          "do_cloud_translation")
+
+    with translate_client_lock:
+        if translate_client is None:
+            translate_client = translate.Client()
+
+    return translate_client
+
+
 def translate_text(text, target, source):
     """Translates text from source language into target language.
     
     Target and source must be ISO 639-1 language codes.
     https://googleapis.dev/python/translation/latest/client.html
     """
-    translate_client = translate.Client()
+    translate_client = get_translate_client()
 
     # Text can also be a sequence of strings, in which case this method
     # will return a sequence of results for each text.
@@ -81,29 +118,155 @@ def translate_text(text, target, source):
     return result
 
 
-def translate_long_list(inlist, target, source):
-    """Translates inlist of text using the 'translate_text' function.
+def google_backend(texts, target, source):
+    """Returns the Google translations of the list of strings 'texts'.
+    Any function taking the same arguments and returning a list of
+    translations can be used instead by 'translate_with_cache'."""
 
-    The maximum number of strings in 'translate_text' is 128.
-    Hence this function splits inlist and calls 'translate_text'
-    on each part separately, collecting the results.
-    See 'translate_text' for target and source specification.
-    """
-    print(f"Translating {len(''.join(inlist))} characters.")
+    return [r['translatedText'] for r in translate_text(texts, target,
+                                                        source)]
 
-    nstrings = 128
-    result = []
-    for i in range(0, len(inlist), nstrings):
-        sub = inlist[i:i+nstrings]
-        result = result + translate_text(sub, target, source)
 
-    return result
+def open_translation_cache(path=translation_cache_path):
+    """Opens the translation cache at path, creating it if needed."""
+
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE IF NOT EXISTS translations ("
+                "source TEXT, target TEXT, text TEXT, translation TEXT, "
+                "PRIMARY KEY (source, target, text))")
+
+    return con
 
 
-def fix_case(arr, outlang):
+def get_cached_translations(con, texts, target, source):
+    """Returns a dictionary of the cached translations of those of 'texts'
+    which are in the cache."""
+
+    cached = dict()
+    texts = list(texts)
+
+    # SQLite limits the number of parameters of a query
+    for i in range(0, len(texts), 500):
+        sub = texts[i:i+500]
+        cached.update(con.execute(
+            "SELECT text, translation FROM translations "
+            "WHERE source = ? AND target = ? AND text IN "
+            f"({', '.join('?' * len(sub))})",
+            [source, target] + sub).fetchall())
+
+    return cached
+
+
+def pack_batches(texts, max_strings, max_chars):
+    """Splits the list 'texts' into consecutive batches of at most
+    max_strings strings and, unless a single string is longer,
+    at most max_chars characters."""
+
+    batches = list()
+    batch = list()
+    chars = 0
+
+    for text in texts:
+        if batch and (len(batch) == max_strings
+                      or chars + len(text) > max_chars):
+            batches += [batch]
+            batch = list()
+            chars = 0
+        batch += [text]
+        chars += len(text)
+
+    if batch:
+        batches += [batch]
+
+    return batches
+
+
+def translate_with_cache(requested, backend=google_backend,
+                         cache_path=translation_cache_path):
+    """Translates the texts in 'requested', a dictionary of a set of texts
+    for each (target, source) pair, and returns a dictionary of a
+    dictionary of the translation of each text for each pair.
+    Each text is translated only once per pair, and only if it is not in
+    the translation cache at cache_path yet. The texts missing are sent to
+    'backend' (see 'google_backend') in batches packed by
+    'pack_batches', translate_concurrency at once, and each batch is
+    added to the cache as soon as it is translated, so that an
+    interrupted run does not lose what was paid for already. If a request
+    fails, the batches not sent yet are cancelled, those being translated
+    are still added to the cache, and the error is raised."""
+
+    con = open_translation_cache(cache_path)
+    translations = dict()
+    batches = list()
+
+    for (target, source), texts in requested.items():
+
+        texts = sorted(set(texts))
+        translations[(target, source)] = get_cached_translations(
+            con, texts, target, source)
+        missing = [text for text in texts
+                   if text not in translations[(target, source)]]
+
+        print(f"{source} to {target}: {len(texts)} distinct texts, "
+              f"{len(texts) - len(missing)} cached, translating "
+              f"{len(missing)} ({len(''.join(missing))} characters).")
+
+        batches += [(target, source, batch) for batch
+                    in pack_batches(missing, translate_batch_size,
+                                    translate_batch_chars)]
+
+    saved = set()
+
+    def save(future):
+        target, source, batch = futures[future]
+        result = future.result()
+        if len(result) != len(batch):
+            raise Exception("Error: Number of translations returned:",
+                            len(result), "Number of texts sent:", len(batch))
+        with con:
+            con.executemany(
+                "INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?)",
+                [(source, target, text, translation)
+                 for text, translation in zip(batch, result)])
+        translations[(target, source)].update(zip(batch, result))
+        saved.add(future)
+
+    try:
+        with ThreadPoolExecutor(translate_concurrency) as pool:
+
+            futures = {pool.submit(backend, batch, target, source):
+                       (target, source, batch)
+                       for target, source, batch in batches}
+
+            try:
+                for future in as_completed(futures):
+                    save(future)
+
+            except BaseException:
+                # send no further batches, but keep those translated by
+                # the requests already sent
+                for future in futures:
+                    future.cancel()
+                wait(futures)
+                for future in futures:
+                    if (future not in saved and not future.cancelled()
+                        and future.exception() is None
+                        and len(future.result()) == len(futures[future][2])):
+                        save(future)
+                raise
+
+    finally:
+        con.close()
+
+    return translations
+
+
+def fix_case_with_scans(arr, outlang):
     """Fix the case of the strings in array 'arr' and return it.
 
     The list of 1-grams in language 'outlang' is used to set the case.
+    Original implementation of 'fix_case', scanning the list for each
+    string.
     """
     reffile = ngramlist_path(1, outlang)
     dr = pd.read_csv(reffile)
@@ -127,22 +290,108 @@ def fix_case(arr, outlang):
     return arr
 
 
+# vocabulary of each list of 1-grams used by 'fix_case', by path,
+# together with the modification time of the file it was read from
+case_vocabularies = dict()
+
+def get_case_vocabulary(outlang):
+    """Returns the set of 1-grams of language 'outlang', read once and
+    reread only if the file changes."""
+
+    reffile = ngramlist_path(1, outlang)
+    mtime = os.path.getmtime(reffile)
+
+    if case_vocabularies.get(reffile, (None,))[0] != mtime:
+        dr = pd.read_csv(reffile)
+        case_vocabularies[reffile] = (mtime, set(dr.ngram))
+
+    return case_vocabularies[reffile][1]
+
+
+def fix_case(arr, outlang):
+    """Fix the case of the strings in array 'arr' and return them as an
+    array.
+
+    The list of 1-grams in language 'outlang' is used to set the case:
+    a string not in it is replaced by the string with the case of its
+    first character swapped if that is in it, or else, if its first word
+    is not in lower case but its second and third (if any) are, by the
+    string with its first word in lower case if that word is in it.
+    Same result as 'fix_case_with_scans', but all strings are handled at
+    once using hash lookups.
+    """
+    vocabulary = get_case_vocabulary(outlang)
+    s = pd.Series(arr, dtype=object)
+    out = s.copy()
+
+    todo = ~s.isin(vocabulary) & (s.str.len() > 0)
+
+    swapped = s[todo].str[0].str.swapcase() + s[todo].str[1:]
+    use_swapped = swapped.isin(vocabulary)
+    out[use_swapped[use_swapped].index] = swapped[use_swapped]
+
+    rest = s[todo][~use_swapped]
+    if len(rest) == 0:
+        return out.to_numpy()
+
+    parts = rest.str.partition(" ")
+    first, space, others = parts[0], parts[1], parts[2]
+    parts = others.str.partition(" ")
+    second, space2, third = parts[0], parts[1], parts[2].str.partition(" ")[0]
+    lower = first.str.lower()
+
+    use_lower = ((space == " ") & (first != lower)
+                 & (second == second.str.lower())
+                 & ((space2 == "") | (third == third.str.lower()))
+                 & lower.isin(vocabulary))
+    out[use_lower[use_lower].index] = (lower + " " + others)[use_lower]
+
+    return out.to_numpy()
+
+
+# manual translations, read once, and those of each (lang, outlang)
+manual_translations = None
+manual_translations_by_pair = dict()
+
+def get_manual_translations(lang, outlang):
+    """Returns a dictionary of the manual translation of each ngram of lang
+    to outlang in "python/extra_settings/manual_translations_1grams.csv";
+    of an ngram given several times, the last translation is used."""
+
+    global manual_translations
+
+    if manual_translations is None:
+        manual_translations = pd.read_csv(
+            "python/extra_settings/manual_translations_1grams.csv")
+
+    if (lang, outlang) not in manual_translations_by_pair:
+        df = manual_translations
+        incol, outcol = langiso[lang], langiso[lang] + '_' + langiso[outlang]
+        if incol in df.columns and outcol in df.columns:
+            df = df[df[incol].notnull()]
+            manual_translations_by_pair[(lang, outlang)] = dict(
+                zip(df[incol], df[outcol]))
+        else:
+            manual_translations_by_pair[(lang, outlang)] = dict()
+
+    return manual_translations_by_pair[(lang, outlang)]
+
+
 def fix_translation(d, lang, outlang):
-    """Fix the translations from a manually supplied csv-file."""
-    df = pd.read_csv("python/extra_settings/manual_translations_1grams.csv")
-    
-    d.set_index('ngram', inplace=True)
-    
-    for i in df.index[df[langiso[lang]].notnull()]:
-        key = df[langiso[lang]][i]
-        d.loc[key, langiso[outlang]] = (df[langiso[lang] + '_'
-                                        + langiso[outlang]][i])
-    
-    d.reset_index(inplace=True)
+    """Fix the translations from a manually supplied csv-file.
+    Only the ngrams in d are fixed, so lists of any n can be fixed."""
+
+    overrides = get_manual_translations(lang, outlang)
+    fix = d['ngram'].isin(overrides.keys())
+
+    d.loc[fix, langiso[outlang]] = d.loc[fix, 'ngram'].map(overrides)
+
     return d
 
 
-def ngramlist_add_translation(n, lang, outlang):
+def read_ngramlist(n, lang):
+    """Returns the list of n-grams of lang to translate and the path to
+    save it to."""
 
     infile = ngramlist_path(n, lang)
     d = pd.read_csv(infile)
@@ -154,12 +403,24 @@ def ngramlist_add_translation(n, lang, outlang):
     else:
         outfile = infile
 
+    return d, outfile
+
+
+def ngramlist_add_translation(n, lang, outlang, translations=None,
+                              backend=google_backend):
+    """Adds the translations to outlang to the list of n-grams of lang.
+    If do_cloud_translation, the translations are taken from the
+    dictionary 'translations' by (target, source) and ngram if given,
+    otherwise obtained by 'translate_with_cache' using 'backend'."""
+
+    d, outfile = read_ngramlist(n, lang)
+
     if do_cloud_translation:
-        inlist = d['ngram'].to_list()        
-        result = translate_long_list(inlist,
-                                     target=langiso[outlang],
-                                     source=langiso[lang])    
-        d[langiso[outlang]] = [i['translatedText'] for i in result]
+        pair = (langiso[outlang], langiso[lang])
+        if translations is None:
+            translations = translate_with_cache(
+                {pair: set(d['ngram'].dropna())}, backend)
+        d[langiso[outlang]] = d['ngram'].map(translations[pair])
     
     # Fix: Google returns "'" as "&#39;" for some reason
     d[langiso[outlang]] = d[langiso[outlang]].fillna(value="")
@@ -180,7 +441,12 @@ def ngramlist_add_translation(n, lang, outlang):
     d.to_csv(outfile,index=False, header=True)
 
     
-def ngramlist_add_translation_all(ns, langs, outlang):
+def ngramlist_add_translation_all(ns, langs, outlang,
+                                  backend=google_backend):
+    """Adds the translations to outlang to the lists of n-grams of each of
+    langs and ns. If do_cloud_translation, the ngrams of all lists are
+    translated at once first, each distinct one only once per language
+    (see 'translate_with_cache')."""
     
     if outlang in ["english", "english-fiction"]:
         if "english" in langs:
@@ -190,6 +456,17 @@ def ngramlist_add_translation_all(ns, langs, outlang):
     else:
         if outlang in langs:
             langs.remove(outlang)
+
+    translations = None
+
+    if do_cloud_translation:
+        requested = dict()
+        for lang in langs:
+            for n in ns:
+                d, outfile = read_ngramlist(n, lang)
+                requested.setdefault((langiso[outlang], langiso[lang]),
+                                     set()).update(d['ngram'].dropna())
+        translations = translate_with_cache(requested, backend)
             
     for lang in langs:
         
@@ -199,7 +476,8 @@ def ngramlist_add_translation_all(ns, langs, outlang):
             
             print("n:", n)
             
-            ngramlist_add_translation(n, lang, outlang)
+            ngramlist_add_translation(n, lang, outlang, translations,
+                                      backend)
 
 
 ###############################################################################
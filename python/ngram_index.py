@@ -0,0 +1,458 @@
+# Compile the final lists in folder 'ngrams' into one memory-mapped index and
+# look up ngrams in it without parsing the csv-files again
+# run from repository root directory 'google-books-ngram-frequency'
+
+# Build the index by running this script, then e.g.:
+#   index = load_index()
+#   lookup(index, "french", 1, "maison")
+#   rank_range(index, "french", 1, 1, 10)
+#   prefix_search(index, "french", 2, "de l")
+#   top_completions(index, "french", 2, "de l", 10)
+
+import pandas as pd
+import numpy as np
+import bisect, heapq, json, mmap, os, re
+from timeit import default_timer as timer
+
+import google_cloud_translate as translate
+
+
+###############################################################################
+# Settings
+
+# Where to save the index
+index_path = "ngrams/more/ngram_index.bin"
+
+# Folder with the final lists {n}grams_{lang}.csv to compile into the index
+ngramlists_path = "ngrams"
+
+
+###############################################################################
+# Constants etc.
+
+index_magic = b"NGRAMIX1"
+
+# arrays of each table, by name and dtype:
+#   ngram_pool, ngram_offsets: sorted ngrams, concatenated, and where each
+#                              of them starts (plus the end of the last one)
+#   sorted_rank:               rank of each sorted ngram
+#   rank_sorted:               position among the sorted ngrams by rank
+#   freq, cumshare:            by rank; cumshare is NaN if not in the list
+#   translation_pool, translation_offsets: translations by rank, if any,
+#                              see 'translation_column'
+#   trie_*:                    nodes of a radix trie over the sorted ngrams,
+#                              see 'compile_trie'
+table_arrays = [("ngram_pool", "u1"), ("ngram_offsets", "<i8"),
+                ("sorted_rank", "<i4"), ("rank_sorted", "<i4"),
+                ("freq", "<i8"), ("cumshare", "<f8"),
+                ("translation_pool", "u1"), ("translation_offsets", "<i8"),
+                ("trie_first", "<i4"), ("trie_last", "<i4"),
+                ("trie_depth", "<i4"), ("trie_byte", "u1"),
+                ("trie_terminal", "<i4"), ("trie_children", "<i4"),
+                ("trie_nchildren", "<i4"), ("trie_max_freq", "<i8"),
+                ("trie_best_rank", "<i4")]
+
+ngramlist_pattern = re.compile(r"^(\d+)grams_(.+)\.csv$")
+
+
+###############################################################################
+# Functions
+
+def pool_and_offsets(strings):
+    """Returns the UTF-8 encoded 'strings' concatenated as a uint8 array
+    and an array of where each of them starts, plus the end of the last."""
+
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+
+    return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+def common_prefix_length(a, b):
+    """Returns the length of the longest common prefix of a and b."""
+
+    i = 0
+    while i < min(len(a), len(b)) and a[i] == b[i]:
+        i += 1
+
+    return i
+
+
+def compile_trie(sorted_ngrams, sorted_rank, sorted_freq):
+    """Returns the arrays 'trie_*' of a radix trie over the list of UTF-8
+    encoded, sorted ngrams 'sorted_ngrams', with the rank and frequency of
+    each in sorted_rank and sorted_freq. Each node stands for the prefix
+    shared by the sorted ngrams from trie_first to before trie_last, whose
+    length trie_depth is the longest such prefix, so that nodes with only
+    one child do not exist. trie_terminal is the number of these ngrams
+    equal to the prefix, which come first, trie_byte the byte at which the
+    node branches off its parent, and the trie_nchildren children of a
+    node are numbered consecutively from trie_children on, by their
+    trie_byte. trie_max_freq and trie_best_rank are the highest frequency
+    and lowest rank of the node's ngrams, which bound those of any
+    completion of its prefix. Node 0 is the root."""
+
+    nodes = {name: list() for name, dtype in table_arrays
+             if name.startswith("trie_")}
+
+    def add_node(first, last, byte):
+        depth = common_prefix_length(sorted_ngrams[first],
+                                     sorted_ngrams[last - 1])
+        nodes["trie_first"] += [first]
+        nodes["trie_last"] += [last]
+        nodes["trie_depth"] += [depth]
+        nodes["trie_byte"] += [byte]
+        nodes["trie_max_freq"] += [int(sorted_freq[first:last].max())]
+        nodes["trie_best_rank"] += [int(sorted_rank[first:last].min())]
+
+    if len(sorted_ngrams) > 0:
+        add_node(0, len(sorted_ngrams), 0)
+
+    # breadth first, so that the children of each node are consecutive
+    i = 0
+    while i < len(nodes["trie_first"]):
+
+        first, last = nodes["trie_first"][i], nodes["trie_last"][i]
+        depth = nodes["trie_depth"][i]
+
+        terminal = 0
+        while (first + terminal < last
+               and len(sorted_ngrams[first + terminal]) == depth):
+            terminal += 1
+
+        nodes["trie_terminal"] += [terminal]
+        nodes["trie_children"] += [len(nodes["trie_first"])]
+
+        # the remaining ngrams are grouped by their byte after the prefix
+        child_first = first + terminal
+        while child_first < last:
+            byte = sorted_ngrams[child_first][depth]
+            child_last = child_first + 1
+            while (child_last < last
+                   and sorted_ngrams[child_last][depth] == byte):
+                child_last += 1
+            add_node(child_first, child_last, byte)
+            child_first = child_last
+
+        nodes["trie_nchildren"] += [len(nodes["trie_first"])
+                                    - nodes["trie_children"][i]]
+        i += 1
+
+    return {name: np.array(values, dtype=np.int64)
+            for name, values in nodes.items()}
+
+
+def translation_column(d):
+    """Returns the name of the column of translations of the final list d,
+    which google_cloud_translate.py names by the ISO code of the language
+    translated to (see langiso there), or None if it has none; of several,
+    the first is used."""
+
+    codes = set(translate.langiso.values())
+
+    return next((column for column in d.columns if column in codes), None)
+
+
+def compile_table(d):
+    """Returns the arrays of 'table_arrays' for the final list d, whose rows
+    are ordered by rank."""
+
+    ngrams = [ngram.encode('utf-8') for ngram in d['ngram']]
+
+    # sort by UTF-8 bytes, equal ngrams by rank
+    order = sorted(range(len(ngrams)), key=lambda i: (ngrams[i], i))
+
+    arrays = dict()
+    arrays["ngram_pool"], arrays["ngram_offsets"] = pool_and_offsets(
+        [d['ngram'].iat[i] for i in order])
+    arrays["sorted_rank"] = np.array(order, dtype=np.int32) + 1
+    arrays["rank_sorted"] = np.zeros(len(order), dtype=np.int32)
+    arrays["rank_sorted"][order] = np.arange(len(order), dtype=np.int32)
+    arrays["freq"] = d['freq'].to_numpy(dtype=np.int64)
+    arrays.update(compile_trie([ngrams[i] for i in order],
+                               arrays["sorted_rank"],
+                               arrays["freq"][order]))
+
+    if 'cumshare' in d.columns:
+        arrays["cumshare"] = pd.to_numeric(
+            d['cumshare'], errors='coerce').to_numpy(dtype=np.float64)
+    else:
+        arrays["cumshare"] = np.full(len(d), np.nan)
+
+    column = translation_column(d)
+    if column is not None:
+        arrays["translation_pool"], arrays["translation_offsets"] = \
+            pool_and_offsets(d[column])
+    else:
+        arrays["translation_pool"], arrays["translation_offsets"] = \
+            pool_and_offsets([])
+
+    return arrays
+
+
+def build_index(path=index_path):
+    """Compiles all final lists in ngramlists_path into one file at path:
+    the magic bytes 'index_magic', the length of a JSON header as
+    little-endian int64, the header, and the arrays of 'table_arrays' for
+    each table, each aligned to 8 bytes. The header gives for each table
+    its language, n, number of rows, and the offset and length of each
+    array, and the ISO code of the language of its translations, if any.
+    The file is written to a temporary file first and then renamed.
+    """
+
+    tables = list()
+    data = list()
+    offset = 0
+
+    for filename in sorted(os.listdir(ngramlists_path)):
+
+        m = ngramlist_pattern.match(filename)
+        if m is None:
+            continue
+
+        d = pd.read_csv(f"{ngramlists_path}/{filename}",
+                        keep_default_na=False, dtype={'ngram': str})
+        arrays = compile_table(d)
+
+        column = translation_column(d)
+        table = {"lang": m.group(2), "n": int(m.group(1)), "rows": len(d),
+                 "translations": column is not None,
+                 "translation_lang": column, "arrays": dict()}
+
+        for name, dtype in table_arrays:
+            a = arrays[name].astype(dtype)
+            table["arrays"][name] = [offset, a.size]
+            data += [a.tobytes(), b"\0" * (-a.nbytes % 8)]
+            offset += a.nbytes + (-a.nbytes % 8)
+
+        tables += [table]
+
+    header = json.dumps({"tables": tables}).encode('utf-8')
+    header += b" " * (-len(header) % 8)
+
+    with open(path + ".tmp", 'wb') as f:
+        f.write(index_magic)
+        f.write(np.array([len(header)], dtype='<i8').tobytes())
+        f.write(header)
+        for b in data:
+            f.write(b)
+
+    os.replace(path + ".tmp", path)
+
+    return path
+
+
+def load_index(path=index_path):
+    """Memory-maps the index at path and reads its header. Returns a
+    dictionary with the memory map, where the arrays start, and the
+    header of each table (lang, n); the arrays of a table are only mapped
+    when first looked up (see 'get_table')."""
+
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if buf[:len(index_magic)] != index_magic:
+        raise ValueError(f"{path} is not an ngram index")
+
+    header_size = int.from_bytes(buf[len(index_magic):len(index_magic) + 8],
+                                 'little')
+    start = len(index_magic) + 8 + header_size
+    header = json.loads(buf[len(index_magic) + 8:start])
+
+    return {"buf": buf, "start": start,
+            "tables": {(table["lang"], table["n"]): table
+                       for table in header["tables"]},
+            "mapped": dict()}
+
+
+def get_table(index, lang, n):
+    """Returns a dictionary of the arrays of the list of n-grams of lang in
+    'index' as views into the file, plus its number of rows, whether it
+    has translations and their language."""
+
+    if (lang, n) not in index["mapped"]:
+
+        table = index["tables"][(lang, n)]
+        arrays = {"rows": table["rows"],
+                  "translations": table["translations"],
+                  "translation_lang": table.get("translation_lang")}
+
+        for name, dtype in table_arrays:
+            offset, size = table["arrays"][name]
+            arrays[name] = np.frombuffer(index["buf"], dtype=dtype,
+                                         count=size,
+                                         offset=index["start"] + offset)
+
+        index["mapped"][(lang, n)] = arrays
+
+    return index["mapped"][(lang, n)]
+
+
+class SortedNgrams:
+    """Read-only sequence of the UTF-8 encoded ngrams of a table in byte
+    order, for binary search with 'bisect'."""
+
+    def __init__(self, table):
+        self.pool = table["ngram_pool"]
+        self.offsets = table["ngram_offsets"]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.pool[self.offsets[i]:self.offsets[i + 1]].tobytes()
+
+
+def entry(table, rank):
+    """Returns a dictionary of ngram, rank, freq, cumshare, and translation
+    (None if the list has none) of the ngram of rank 'rank' in table."""
+
+    i = rank - 1
+    j = int(table["rank_sorted"][i])
+    pool, offsets = table["ngram_pool"], table["ngram_offsets"]
+
+    translation = None
+    if table["translations"]:
+        translation = table["translation_pool"][
+            table["translation_offsets"][i]:
+            table["translation_offsets"][i + 1]].tobytes().decode('utf-8')
+
+    return {"ngram": pool[offsets[j]:offsets[j + 1]].tobytes()
+                     .decode('utf-8'),
+            "rank": rank,
+            "freq": int(table["freq"][i]),
+            "cumshare": float(table["cumshare"][i]),
+            "translation": translation}
+
+
+def lookup(index, lang, n, ngram):
+    """Returns the entry (see 'entry') of ngram in the list of n-grams of
+    lang, or None if it is not in the list. Takes O(log(rows))."""
+
+    table = get_table(index, lang, n)
+    key = ngram.encode('utf-8')
+    sorted_ngrams = SortedNgrams(table)
+
+    j = bisect.bisect_left(sorted_ngrams, key)
+    if j == len(sorted_ngrams) or sorted_ngrams[j] != key:
+        return None
+
+    return entry(table, int(table["sorted_rank"][j]))
+
+
+def rank_range(index, lang, n, first_rank, last_rank):
+    """Returns the entries (see 'entry') of rank first_rank to last_rank,
+    both included, in the list of n-grams of lang."""
+
+    table = get_table(index, lang, n)
+
+    return [entry(table, rank) for rank
+            in range(max(first_rank, 1), min(last_rank, table["rows"]) + 1)]
+
+
+def prefix_search(index, lang, n, prefix, limit=None):
+    """Returns the entries (see 'entry') of the ngrams starting with prefix
+    in the list of n-grams of lang, by rank, at most 'limit' of them.
+    Takes O(log(rows)) to find the ngrams, which are adjacent in byte
+    order, plus the time to sort them by rank."""
+
+    table = get_table(index, lang, n)
+    key = prefix.encode('utf-8')
+    sorted_ngrams = SortedNgrams(table)
+
+    # no UTF-8 encoded string contains the byte 0xff
+    first = bisect.bisect_left(sorted_ngrams, key)
+    last = bisect.bisect_left(sorted_ngrams, key + b"\xff", lo=first)
+
+    ranks = np.sort(table["sorted_rank"][first:last])[:limit]
+
+    return [entry(table, int(rank)) for rank in ranks]
+
+
+def find_trie_node(table, key):
+    """Returns the node of the radix trie of table whose ngrams are exactly
+    those starting with the UTF-8 encoded prefix key, or None if there are
+    none."""
+
+    sorted_ngrams = SortedNgrams(table)
+    node = 0
+
+    if len(table["trie_first"]) == 0:
+        return None
+
+    while True:
+
+        depth = int(table["trie_depth"][node])
+
+        # the bytes skipped by the radix trie are checked once at the end
+        if depth >= len(key):
+            if sorted_ngrams[int(table["trie_first"][node])][:len(key)] \
+                    != key:
+                return None
+            return node
+
+        children = int(table["trie_children"][node])
+        nchildren = int(table["trie_nchildren"][node])
+        child = children + int(np.searchsorted(
+            table["trie_byte"][children:children + nchildren], key[depth]))
+
+        if (child == children + nchildren
+                or table["trie_byte"][child] != key[depth]):
+            return None
+
+        node = child
+
+
+def top_completions(index, lang, n, prefix, k=10):
+    """Returns the entries (see 'entry') of the k most frequent ngrams
+    starting with prefix in the list of n-grams of lang, by decreasing
+    frequency. Searches the radix trie best first: nodes are visited in
+    order of their maximum frequency, so only the nodes leading to the
+    k results and their siblings are visited, however many ngrams start
+    with prefix."""
+
+    table = get_table(index, lang, n)
+    node = find_trie_node(table, prefix.encode('utf-8'))
+
+    if node is None:
+        return list()
+
+    results = list()
+
+    # heap of (-frequency, rank, is a node, node or sorted position)
+    heap = [(-int(table["trie_max_freq"][node]),
+             int(table["trie_best_rank"][node]), True, node)]
+
+    while heap and len(results) < k:
+
+        minus_freq, rank, is_node, i = heapq.heappop(heap)
+
+        if not is_node:
+            results += [entry(table, rank)]
+            continue
+
+        first = int(table["trie_first"][i])
+        for j in range(first, first + int(table["trie_terminal"][i])):
+            rank = int(table["sorted_rank"][j])
+            heapq.heappush(heap, (-int(table["freq"][rank - 1]), rank,
+                                  False, j))
+
+        children = int(table["trie_children"][i])
+        for child in range(children,
+                           children + int(table["trie_nchildren"][i])):
+            heapq.heappush(heap, (-int(table["trie_max_freq"][child]),
+                                  int(table["trie_best_rank"][child]),
+                                  True, child))
+
+    return results
+
+
+###############################################################################
+# Run
+
+if __name__ == '__main__':
+    start = timer()
+    build_index()
+    print(f"built {index_path}: {round(timer() - start, 2)}s, "
+          f"{round(os.path.getsize(index_path) / 1e6, 1)} MB")
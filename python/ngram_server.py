@@ -0,0 +1,336 @@
+# Serve lookups of the rank, frequency, cumshare and translation of ngrams
+# over HTTP from the index built by ngram_index.py
+# run from repository root directory 'google-books-ngram-frequency'
+
+# Endpoints, all returning JSON:
+#   GET  /lookup?lang=french&n=1&ngram=maison&ngram=chat
+#   POST /lookup  {"lang": "french", "n": 1, "ngrams": ["maison", "chat"]}
+#   GET  /ranks?lang=french&n=1&first=1&last=100
+#   GET  /complete?lang=french&n=2&prefix=de%20l&k=10
+#   GET  /metrics
+
+import asyncio, json, os, time
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+from timeit import default_timer as timer
+
+import ngram_index
+
+
+###############################################################################
+# Settings
+
+# Where to listen
+host = "127.0.0.1"
+port = 8642
+
+# Largest request body accepted, in bytes
+max_body_size = 2**24
+
+# Number of latest requests over which latency percentiles are reported
+latency_window = 10000
+
+
+###############################################################################
+# Constants etc.
+
+reasons = {200: "OK", 400: "Bad Request", 404: "Not Found",
+           405: "Method Not Allowed", 413: "Payload Too Large",
+           500: "Internal Server Error"}
+
+class RequestError(Exception):
+    """Raised to answer a request with an HTTP error status."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+###############################################################################
+# Functions
+
+def new_metrics():
+    """Returns a dictionary of the metrics reported by /metrics."""
+
+    return {"started": time.time(), "requests": dict(), "errors": 0,
+            "ngrams": 0, "latencies": deque(maxlen=latency_window)}
+
+
+def metrics_report(metrics):
+    """Returns the metrics as a dictionary which can be dumped as JSON:
+    the number of requests per endpoint, of errors, and of ngrams looked
+    up, requests and ngrams per second since the start, and percentiles of
+    the latency of the latest latency_window requests in milliseconds."""
+
+    uptime = time.time() - metrics["started"]
+    latencies = sorted(metrics["latencies"])
+    requests = sum(metrics["requests"].values())
+
+    def percentile(p):
+        if not latencies:
+            return None
+        return round(1e3 * latencies[min(int(p / 100 * len(latencies)),
+                                         len(latencies) - 1)], 3)
+
+    return {"uptime_seconds": round(uptime, 3),
+            "requests": metrics["requests"],
+            "errors": metrics["errors"],
+            "ngrams_looked_up": metrics["ngrams"],
+            "requests_per_second": round(requests / uptime, 1),
+            "ngrams_per_second": round(metrics["ngrams"] / uptime, 1),
+            "latency_ms": {"p50": percentile(50), "p90": percentile(90),
+                           "p99": percentile(99),
+                           "max": percentile(100)}}
+
+
+def encode(response):
+    """Returns the response as UTF-8 encoded JSON."""
+
+    return json.dumps(response, ensure_ascii=False).encode('utf-8')
+
+
+def load_tables(index):
+    """Returns for each table (lang, n) of the index a dictionary of the
+    rank of each ngram, and a list of the entries (see
+    'ngram_index.entry') by rank, each encoded as JSON already, so that
+    answering a lookup only takes a hash lookup per ngram. A missing
+    cumshare is given as null, since NaN is not valid JSON."""
+
+    tables = dict()
+
+    for lang, n in index["tables"]:
+
+        entries = ngram_index.rank_range(index, lang, n, 1,
+                                         index["tables"][(lang, n)]["rows"])
+        ranks = dict()
+
+        for entry in entries:
+            ranks.setdefault(entry["ngram"], entry["rank"])
+            if entry["cumshare"] != entry["cumshare"]:
+                entry["cumshare"] = None
+
+        tables[(lang, n)] = {"ranks": ranks,
+                             "entries": [encode(entry) for entry in entries]}
+
+    return tables
+
+
+def encode_results(entries):
+    """Returns the JSON encoded entries 'entries' as the encoded response
+    {"results": [...]}."""
+
+    return b'{"results": [' + b", ".join(entries) + b']}'
+
+
+def get_param(params, name, convert=str, default=None):
+    """Returns the query or body parameter 'name' converted by 'convert',
+    or 'default' if it is missing. Raises a RequestError if it is not a
+    string, or an integer where one is asked for."""
+
+    if name not in params:
+        if default is None:
+            raise RequestError(400, f"missing parameter '{name}'")
+        return default
+
+    value = params[name]
+    if isinstance(value, list):
+        value = value[0]
+
+    # a JSON body may give an integer already, but e.g. 1.5, true or null
+    # must not be converted
+    if convert is int and type(value) is int:
+        return value
+    if not isinstance(value, str):
+        raise RequestError(400, f"invalid parameter '{name}'")
+
+    try:
+        return convert(value)
+    except ValueError:
+        raise RequestError(400, f"invalid parameter '{name}'")
+
+
+def get_table_key(index, params):
+    """Returns the (lang, n) of the table requested in 'params'."""
+
+    key = (get_param(params, "lang"), get_param(params, "n", int))
+
+    if key not in index["tables"]:
+        raise RequestError(404, f"no list of {key[1]}-grams for {key[0]}")
+
+    return key
+
+
+def handle(index, tables, metrics, method, path, query, body):
+    """Returns the JSON encoded response to a request."""
+
+    if path == "/metrics":
+        return encode(metrics_report(metrics))
+
+    if method == "POST":
+        try:
+            params = json.loads(body)
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            raise RequestError(400, "body is not valid JSON")
+        if not isinstance(params, dict):
+            raise RequestError(400, "body is not a JSON object")
+    elif method == "GET":
+        params = parse_qs(query, keep_blank_values=True)
+    else:
+        raise RequestError(405, f"method {method} not allowed")
+
+    if path == "/lookup":
+        lang, n = get_table_key(index, params)
+        ngrams = params.get("ngrams", params.get("ngram", list()))
+        if not isinstance(ngrams, list) or not all(isinstance(ngram, str)
+                                                   for ngram in ngrams):
+            raise RequestError(400, "invalid parameter 'ngrams'")
+        metrics["ngrams"] += len(ngrams)
+        ranks = tables[(lang, n)]["ranks"]
+        entries = tables[(lang, n)]["entries"]
+        return encode_results([entries[ranks[ngram] - 1] if ngram in ranks
+                               else b"null" for ngram in ngrams])
+
+    if path == "/ranks":
+        lang, n = get_table_key(index, params)
+        entries = tables[(lang, n)]["entries"]
+        results = entries[max(get_param(params, "first", int) - 1, 0):
+                          max(get_param(params, "last", int), 0)]
+        metrics["ngrams"] += len(results)
+        return encode_results(results)
+
+    if path == "/complete":
+        lang, n = get_table_key(index, params)
+        entries = tables[(lang, n)]["entries"]
+        results = ngram_index.top_completions(
+            index, lang, n, get_param(params, "prefix"),
+            get_param(params, "k", int, 10))
+        metrics["ngrams"] += len(results)
+        return encode_results([entries[entry["rank"] - 1]
+                               for entry in results])
+
+    raise RequestError(404, f"no endpoint {path}")
+
+
+async def read_request(reader):
+    """Reads one HTTP request from reader. Returns its method, target,
+    headers, and body, or None if the connection was closed."""
+
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+
+    try:
+        method, target, version = request_line.decode('latin-1').split()
+    except ValueError:
+        raise RequestError(400, "invalid request line")
+
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode('latin-1').partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get("content-length", 0))
+    except ValueError:
+        raise RequestError(400, "invalid Content-Length")
+    if length > max_body_size:
+        raise RequestError(413, "request body too large")
+
+    body = await reader.readexactly(length) if length > 0 else b""
+
+    return method, target, headers, body
+
+
+async def serve_connection(index, tables, metrics, reader, writer):
+    """Answers the requests on one connection until the client closes it;
+    connections are kept alive for further requests."""
+
+    try:
+        while True:
+
+            try:
+                request = await read_request(reader)
+            except RequestError as e:
+                request = e
+            except (asyncio.IncompleteReadError, ConnectionError):
+                break
+
+            if request is None:
+                break
+
+            start = timer()
+            keep_alive = True
+
+            try:
+                if isinstance(request, RequestError):
+                    keep_alive = False
+                    raise request
+                method, target, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                parts = urlsplit(target)
+                metrics["requests"][parts.path] = \
+                    metrics["requests"].get(parts.path, 0) + 1
+                status = 200
+                data = handle(index, tables, metrics, method, parts.path,
+                              parts.query, body)
+            except RequestError as e:
+                status = e.status
+                data = encode({"error": str(e)})
+                metrics["errors"] += 1
+            except Exception as e:
+                # answer rather than drop the connection on a bug
+                status = 500
+                data = encode({"error": repr(e)})
+                metrics["errors"] += 1
+                keep_alive = False
+
+            writer.write(
+                (f"HTTP/1.1 {status} {reasons[status]}\r\n"
+                 f"Content-Type: application/json; charset=utf-8\r\n"
+                 f"Content-Length: {len(data)}\r\n"
+                 f"Connection: {'keep-alive' if keep_alive else 'close'}"
+                 f"\r\n\r\n").encode('latin-1') + data)
+            await writer.drain()
+
+            metrics["latencies"].append(timer() - start)
+
+            if not keep_alive:
+                break
+
+    finally:
+        writer.close()
+
+
+async def run_server(index=None):
+    """Serves the index (default: load the index at
+    ngram_index.index_path, building it first if it does not exist) on
+    host and port until cancelled. All lists are loaded once at the start
+    (see 'load_tables')."""
+
+    if index is None:
+        if not os.path.exists(ngram_index.index_path):
+            ngram_index.build_index()
+        index = ngram_index.load_index()
+
+    tables = load_tables(index)
+    metrics = new_metrics()
+
+    server = await asyncio.start_server(
+        lambda reader, writer: serve_connection(index, tables, metrics,
+                                                reader, writer),
+        host, port)
+
+    print(f"serving {ngram_index.index_path} on http://{host}:{port}")
+
+    async with server:
+        await server.serve_forever()
+
+
+###############################################################################
+# Run
+
+if __name__ == '__main__':
+    asyncio.run(run_server())